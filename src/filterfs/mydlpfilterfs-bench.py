@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# Copyright (c) 2012 Ozgur Batur
+# License GPLv3, see http://www.gnu.org/licenses/gpl.html#content
+
+# Micro benchmarks for the filterfs data path. They drive MyDLPFilter and
+# FUSE code directly, no mount or SEAP server is needed.
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+from argparse import ArgumentParser
+from ctypes import POINTER, byref, c_byte, cast, create_string_buffer, pointer
+from functools import partial
+from threading import Lock, Thread
+
+import mydlpfuse
+import mydlpfilterfs
+
+mydlpfilterfs.logger = logging.getLogger()
+
+MB = 1024 * 1024
+
+
+def make_files(directory, count, size):
+    block = os.urandom(MB)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "file" + str(i))
+        with open(path, "wb") as f:
+            for j in range(size // MB):
+                f.write(block)
+            f.write(block[:size % MB])
+        paths.append(path)
+    return paths
+
+
+def run_threads(count, target):
+    threads = [Thread(target=target, args=(i,)) for i in range(count)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def make_filter(directory):
+    fs = mydlpfilterfs.MyDLPFilter(directory, directory)
+    fs.scheduler.start()
+    fs.committer.start()
+    return fs
+
+
+def fuse_driver(operations, zero_copy):
+    # a FUSE instance whose callbacks are driven directly, without a mount
+    fuse = mydlpfuse.FUSE.__new__(mydlpfuse.FUSE)
+    fuse.raw_fi = False
+    fuse.encoding = 'utf-8'
+    fuse.zero_copy = zero_copy
+    fuse.fuse_ops = fuse._prepare(operations)
+    return fuse
+
+
+class CallTable(dict):
+
+    # what every callback went through before the dispatch table
+    def __init__(self, operations):
+        dict.__init__(self)
+        self.operations = operations
+
+    def __missing__(self, op):
+        return partial(self.operations, op)
+
+
+def locked_read(lock):
+    # what MyDLPFilter.read did before positional reads
+    def read(path, size, offset, fh):
+        with lock:
+            os.lseek(fh, offset, 0)
+            return os.read(fh, size)
+    return read
+
+
+def bench_read(args):
+    directory = tempfile.mkdtemp(prefix="mydlpep-bench-")
+    try:
+        paths = make_files(directory, args.readers, args.size * MB)
+        fs = make_filter(directory)
+        block = args.block * 1024
+        print("%d readers, %d MB each, %d KB requests" %
+              (args.readers, args.size, args.block))
+        for name, read in (("global lock", locked_read(Lock())),
+                           ("per handle", fs.read)):
+            fhs = [os.open(path, os.O_RDONLY) for path in paths]
+            for fh, path in zip(fhs, paths):
+                fs.files[fh] = mydlpfilterfs.ActiveFile(path, (0, 0, 0), fh,
+                                                        True)
+            def reader(i):
+                fh, path = fhs[i], paths[i]
+                for rnd in range(args.rounds):
+                    offset = 0
+                    while True:
+                        data = read(path, block, offset, fh)
+                        if not data:
+                            break
+                        offset += len(data)
+            elapsed = run_threads(args.readers, reader)
+            for fh in fhs:
+                os.close(fh)
+            total = args.readers * args.size * args.rounds
+            print("%-12s %8.1f MB/s" % (name, total / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_zerocopy(args):
+    directory = tempfile.mkdtemp(prefix="mydlpep-bench-")
+    try:
+        path = make_files(directory, 1, args.size * MB)[0]
+        name = "/" + os.path.basename(path)
+        fs = make_filter(directory)
+        print("%d MB per round, %d rounds, MB/s per core" %
+              (args.size, args.rounds))
+        for block in args.blocks:
+            size = block * 1024
+            buf = create_string_buffer(size)
+            bufp = cast(buf, POINTER(c_byte))
+            for op in ("read", "write"):
+                results = []
+                for zero_copy in (False, True):
+                    fuse = fuse_driver(fs, zero_copy)
+                    if op == "read":
+                        fh = fs.open(path, os.O_RDONLY)
+                        call = fuse.read
+                    else:
+                        fh = fs.create(path + ".out", 0600)
+                        call = fuse.write
+                    fi = mydlpfuse.fuse_file_info()
+                    fi.fh = fh
+                    fip = pointer(fi)
+                    started = cpu_time()
+                    for rnd in range(args.rounds):
+                        for offset in range(0, args.size * MB, size):
+                            call(name, bufp, size, offset, fip)
+                    elapsed = cpu_time() - started
+                    fs.release(path, fh)
+                    results.append(args.size * args.rounds /
+                                   max(elapsed, 0.001))
+                print("%-5s %4d KB  copy %8.1f  zero copy %8.1f" %
+                      (op, block, results[0], results[1]))
+        fs.committer.drain()
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_dispatch(args):
+    directory = tempfile.mkdtemp(prefix="mydlpep-bench-")
+    try:
+        path = make_files(directory, 1, 1024 * 1024)[0]
+        name = "/" + os.path.basename(path)
+        fs = make_filter(directory)
+        size = 4096
+        buf = create_string_buffer(size)
+        bufp = cast(buf, POINTER(c_byte))
+        st = mydlpfuse.c_stat()
+        print("%d calls per operation, usec per call" % args.calls)
+        print("%-8s %10s %10s %10s" % ("", "call", "table", "no logging"))
+        results = {}
+        for mode in ("call", "table", "no logging"):
+            fs.log_operations = mode != "no logging"
+            fuse = fuse_driver(fs, True)
+            if mode == "call":
+                fuse.dispatch = CallTable(fs)
+                fuse.decode = lambda path: path.decode(fuse.encoding)
+            ops = fuse.fuse_ops
+            read_fi = mydlpfuse.fuse_file_info()
+            read_fi.fh = fs.open(path, os.O_RDONLY)
+            write_fi = mydlpfuse.fuse_file_info()
+            write_fi.fh = fs.create(path + ".out", 0600)
+            calls = (("getattr", lambda: ops.getattr(name, byref(st))),
+                     ("access", lambda: ops.access(name, os.R_OK)),
+                     ("read", lambda: ops.read(name, bufp, size, 0,
+                                               byref(read_fi))),
+                     ("write", lambda: ops.write(name + ".out", bufp, size,
+                                                 0, byref(write_fi))))
+            for op, call in calls:
+                started = time.time()
+                for i in range(args.calls):
+                    call()
+                elapsed = time.time() - started
+                results.setdefault(op, []).append(elapsed * 1000000 /
+                                                  args.calls)
+            fs.release(path, read_fi.fh)
+            fs.release(path + ".out", write_fi.fh)
+        fs.committer.drain()
+        for op in ("getattr", "access", "read", "write"):
+            print("%-8s %10.2f %10.2f %10.2f" % ((op,) + tuple(results[op])))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="filterfs data path benchmarks")
+    commands = parser.add_subparsers()
+
+    read_parser = commands.add_parser("read",
+                        help="concurrent readers of different files")
+    read_parser.add_argument("--readers", type=int, default=4)
+    read_parser.add_argument("--size", type=int, default=64,
+                             help="file size in MB")
+    read_parser.add_argument("--block", type=int, default=128,
+                             help="request size in KB")
+    read_parser.add_argument("--rounds", type=int, default=4)
+    read_parser.set_defaults(func=bench_read)
+
+    zerocopy_parser = commands.add_parser("zerocopy",
+                        help="FUSE read and write callbacks on one core")
+    zerocopy_parser.add_argument("--size", type=int, default=64,
+                                 help="file size in MB")
+    zerocopy_parser.add_argument("--blocks", type=int, nargs="+",
+                                 default=[4, 32, 128],
+                                 help="request sizes in KB")
+    zerocopy_parser.add_argument("--rounds", type=int, default=4)
+    zerocopy_parser.set_defaults(func=bench_zerocopy)
+
+    dispatch_parser = commands.add_parser("dispatch",
+                        help="per operation overhead of the ctypes callbacks")
+    dispatch_parser.add_argument("--calls", type=int, default=100000)
+    dispatch_parser.set_defaults(func=bench_dispatch)
+
+    args = parser.parse_args()
+    args.func(args)
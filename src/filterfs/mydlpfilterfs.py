@@ -8,282 +8,3208 @@ import os
 import shutil
 import logging
 import time
+import hashlib
+import heapq
+import itertools
+import re
+import fnmatch
+
+from bisect import bisect_left, bisect_right
 
 from errno import *
+from ctypes import CDLL, c_char_p, c_int, c_size_t, c_ssize_t, c_uint, \
+        c_void_p, get_errno
+from ctypes.util import find_library
 from os.path import realpath
 from sys import argv, exit, stdin
-from threading import Lock, Thread
+from argparse import ArgumentParser
+from threading import Condition, Event, Lock, Thread
+from collections import OrderedDict, deque
+from io import FileIO
+from StringIO import StringIO
+from stat import S_IFDIR, S_IFLNK, S_IFREG
+from Queue import Queue, Full
 from socket import socket
+from select import select
 from logging.handlers import SysLogHandler
 
-from mydlpfuse import FUSE, FuseOSError, Operations,\
-        LoggingMixIn, fuse_get_context
+from mydlpfuse import FUSE, FuseOSError, Operations,\
+        LoggingMixIn, fuse_get_context, fuse_version, fuse_can_invalidate,\
+        fuse_invalidate_path
+
+import subprocess
+import signal
+import ConfigParser
+import quopri
+import tempfile
+import pwd
+import fcntl
+
+logger = logging.getLogger("mydlpfilterfs")
+
+try:
+    from os import scandir
+except ImportError:
+    # python-scandir on Python 2
+    from scandir import scandir
+
+TMP_PATH = "/var/tmp/mydlp"
+STAGING_DIR_NAME = ".mydlpep-staging"
+# allowed content that could not be committed, below TMP_PATH
+FAILED_DIR_NAME = "failed"
+SAFE_MNT_PATH = "/var/tmp/mydlpep/safemount"
+CONFIG_FILE = "/etc/mydlp/filterfs.conf"
+
+# 128 KB is the largest request libfuse 2 takes, per callback cost makes
+# anything smaller slower (see mydlpfilterfs-bench.py zerocopy)
+FUSE_BIG_WRITES = True
+FUSE_MAX_WRITE = 128 * 1024
+FUSE_MAX_READ = 128 * 1024
+FUSE_MAX_READAHEAD = 128 * 1024
+FUSE_MAX_BACKGROUND = 32
+FUSE_CONGESTION_THRESHOLD = 24
+FUSE_MULTITHREADED = True
+FUSE_ZERO_COPY = True
+FUSE_SPLICE_READS = True
+FUSE_ATTR_TIMEOUT = 1.0
+FUSE_ENTRY_TIMEOUT = 1.0
+FUSE_NEGATIVE_TIMEOUT = 1.0
+FUSE_LOG_OPERATIONS = False
+# libfuse 3 only, the writeback cache also needs fuse_invalidate_path to drop
+# the pages of blocked writes and is off unless configured
+FUSE_WRITEBACK_CACHE = False
+FUSE_CLONE_FD = True
+FUSE_READDIRPLUS = True
+
+SEAP_SERVER = "127.0.0.1"
+SEAP_PORT = 9099
+SEAP_TIMEOUT = 145
+SEAP_CONNECT_TIMEOUT = 10
+SEAP_RETRY_COUNT = 3
+SEAP_POOL_SIZE = 8
+SEAP_POOL_IDLE_TIMEOUT = 60
+SEAP_PIPELINE = True
+SEAP_MIN_TIMEOUT = 2
+SEAP_TIMEOUT_FACTOR = 4
+SEAP_MIN_THROUGHPUT = 1024 * 1024
+SEAP_BREAKER_THRESHOLD = 3
+SEAP_PROBE_INTERVAL = 5
+SEAP_FAIL_OPEN = False
+# the engine reads scratch files through /proc/<pid>/fd only if enabled and
+# its socket belongs to root or to our user, else from a named copy in tmpfs
+# that it removes after reading
+SEAP_PROC_PATHS = False
+# sequential writes are pushed while they arrive, a stream that falls more
+# than SEAP_STREAM_QUEUE chunks behind the writer is given up for PUSHFILE,
+# off until the PUSH verb is confirmed against the engine
+SEAP_STREAMING = False
+SEAP_STREAM_LIMIT = 4
+SEAP_STREAM_CHUNK = 1024 * 1024
+SEAP_STREAM_QUEUE = 4
+
+RUN_PATH = "/var/run/mydlpep"
+HOUSEKEEPING_INTERVAL = 60
+
+DESTINATION_CLASS = "removable"
+VERDICT_CACHE_SIZE = 4096
+VERDICT_CACHE_TTL = 600
+VERDICT_CACHE_STORE = None
+
+ATTRIBUTE_CACHE_SIZE = 16384
+ATTRIBUTE_CACHE_TTL = 5
+
+DIRECTORY_WINDOW = 1024
+
+SCHEDULER_WORKERS = 8
+SCHEDULER_QUEUE_SIZE = 256
+SCHEDULER_ADMISSION_TIMEOUT = 30
+
+SCRATCH_MEMORY_LIMIT = 4 * 1024 * 1024
+SCRATCH_TMPFS_PATH = "/dev/shm"
+SCRATCH_TMPFS_LIMIT = 64 * 1024 * 1024
+SCRATCH_BUDGET = 256 * 1024 * 1024
+SCRATCH_WAIT = 5
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BUFFER_BUDGET = 32 * 1024 * 1024
+
+# allowed files are written to the device after close() returns
+COMMIT_BACKGROUND = True
+COMMIT_WORKERS = 2
+COMMIT_QUEUE_SIZE = 64
+
+# log only policies, writes commit at once and are inspected afterwards
+AUDIT_MODE = False
+AUDIT_WORKERS = 2
+AUDIT_BACKLOG = 64
+# retained snapshots share SCRATCH_BUDGET with writers, the backlog is held
+# to half of it at most
+AUDIT_BACKLOG_BYTES = 64 * 1024 * 1024
+
+# files matching the local rules are decided without the SEAP engine
+PRECLASSIFIER_ENABLED = True
+PRECLASSIFIER_RULES = "/etc/mydlp/filterfs-rules.conf"
+
+# used while PRECLASSIFIER_RULES does not exist, every condition of a rule
+# has to match and the first matching rule decides. a name is chosen by the
+# writer, so rules allowing by name also need max_size and magic, or
+# trust_name to let anything up to max_size through under that name
+PRECLASSIFIER_DEFAULTS = """
+[empty]
+max_size = 0
+
+# examples to copy into PRECLASSIFIER_RULES, none of them is on by default
+#
+# windows thumbnail caches are OLE compound files
+#[thumbs]
+#glob = Thumbs.db, ehthumbs.db
+#magic = d0cf11e0a1b11ae1
+#max_size = 1048576
+#
+# office and libreoffice lock files hold a user name, anything written
+# under these names up to max_size bytes is not inspected
+#[locks]
+#glob = ~$*, .~lock.*#
+#max_size = 512
+#trust_name = true
+"""
+
+# close() only flushes, durability costs a device cache flush per call
+SYNC_ON_FLUSH = False
+SYNC_ON_RELEASE = True
+
+# config file sections and the constant prefixes they set
+CONFIG_SECTIONS = {"fuse": "FUSE_", "seap": "SEAP_", "scratch": "SCRATCH_",
+                   "scheduler": "SCHEDULER_", "verdict_cache": "VERDICT_CACHE_",
+                   "attribute_cache": "ATTRIBUTE_CACHE_",
+                   "write_buffer": "WRITE_BUFFER_", "sync": "SYNC_",
+                   "commit": "COMMIT_", "audit": "AUDIT_",
+                   "preclassifier": "PRECLASSIFIER_", "filterfs": ""}
+FILTERFS_SETTINGS = ("TMP_PATH", "RUN_PATH", "HOUSEKEEPING_INTERVAL",
+                     "DESTINATION_CLASS", "DIRECTORY_WINDOW")
+
+if hasattr(os, "pread"):
+    pread = os.pread
+    pwrite = os.pwrite
+else:
+    # without positional io callers hold a per descriptor lock instead
+    def pread(fd, size, offset):
+        os.lseek(fd, offset, 0)
+        return os.read(fd, size)
+
+    def pwrite(fd, data, offset):
+        os.lseek(fd, offset, 0)
+        return os.write(fd, data)
+
+
+def copy_range(fsrc, fdst, start, end):
+    while start < end:
+        data = pread(fsrc, min(end - start, 1024 * 1024), start)
+        if not data:
+            return
+        while data:
+            written = pwrite(fdst, data, start)
+            data = data[written:]
+            start += written
+
+
+STAT_KEYS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
+             'st_nlink', 'st_size', 'st_uid')
+
+
+def stat_attributes(st):
+    return dict((key, getattr(st, key)) for key in STAT_KEYS)
+
+
+FICLONE = 0x40049409
+O_TMPFILE = getattr(os, "O_TMPFILE", 020200000)
+O_ACCMODE = getattr(os, "O_ACCMODE", 3)
+MFD_CLOEXEC = 1
+AT_FDCWD = -100
+AT_SYMLINK_FOLLOW = 0x400
+
+try:
+    _libc = CDLL(find_library("c"), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def libc_function(name, argtypes, restype=c_int):
+    function = getattr(_libc, name, None)
+    if function is None:
+        return None
+    function.argtypes = argtypes
+    function.restype = restype
+
+    def call(*args):
+        result = function(*args)
+        if result < 0:
+            errno = get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+    return call
+
+if hasattr(os, "copy_file_range"):
+    copy_file_range = os.copy_file_range
+else:
+    _copy_file_range = libc_function("copy_file_range", [c_int, c_void_p,
+                            c_int, c_void_p, c_size_t, c_uint], c_ssize_t)
+    if _copy_file_range is None:
+        copy_file_range = None
+    else:
+        def copy_file_range(src, dst, count):
+            return _copy_file_range(src, None, dst, None, count, 0)
+
+if hasattr(os, "memfd_create"):
+    memfd_create = os.memfd_create
+else:
+    _memfd_create = libc_function("memfd_create", [c_char_p, c_uint])
+    if _memfd_create is None:
+        memfd_create = None
+    else:
+        def memfd_create(name):
+            return _memfd_create(name, MFD_CLOEXEC)
+
+_linkat = libc_function("linkat", [c_int, c_char_p, c_int, c_char_p, c_int])
+
+
+def link_descriptor(fd, path):
+    # gives an anonymous O_TMPFILE file a name
+    if _linkat is None:
+        raise OSError(ENOSYS, os.strerror(ENOSYS))
+    _linkat(AT_FDCWD, "/proc/self/fd/" + str(fd), AT_FDCWD, path,
+            AT_SYMLINK_FOLLOW)
+
+
+class StagingArea():
+
+    def __init__(self, root):
+        self.root = root
+        # scratch and recovery files, never on the filtered device
+        self.path = TMP_PATH
+        # allowed content about to replace an original
+        self.commit_path = TMP_PATH
+        self.lock = Lock()
+        self.strategies = {}
+        self.commits = {"rename": 0, "copy": 0}
+        self.cloning = False
+
+    def setup(self):
+        if not os.path.isdir(TMP_PATH):
+            os.makedirs(TMP_PATH)
+        # uninspected content stays off the device, only allowed content is
+        # placed on it to make the commit a rename, TMP_PATH is used when
+        # the device refuses the directory
+        candidate = os.path.join(self.root, STAGING_DIR_NAME)
+        try:
+            if not os.path.isdir(candidate):
+                os.mkdir(candidate, 0700)
+            self.reclaim(candidate)
+            self.commit_path = candidate
+        except (IOError, OSError) as why:
+            logger.error("staging setup error " + str(why))
+        try:
+            # originals are cloned into disk scratch files only within a
+            # filesystem
+            self.cloning = (os.stat(self.path).st_dev ==
+                            os.stat(self.root).st_dev and
+                            self.can_clone(self.path))
+        except (IOError, OSError) as why:
+            logger.error("staging setup error " + str(why))
+        logger.info("Staging in " + self.path + ", committing from " +
+                    self.commit_path)
+
+    def close(self):
+        if self.commit_path != TMP_PATH:
+            try:
+                os.rmdir(self.commit_path)
+            except OSError as why:
+                logger.error("staging close error " + str(why))
+
+    def reclaim(self, directory):
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    def can_clone(self, directory):
+        src_handle, src = tempfile.mkstemp(".tmp", "mydlpep-", directory)
+        dst_handle, dst = tempfile.mkstemp(".tmp", "mydlpep-", directory)
+        try:
+            os.write(src_handle, "mydlp")
+            fcntl.ioctl(dst_handle, FICLONE, src_handle)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            os.close(src_handle)
+            os.close(dst_handle)
+            os.remove(src)
+            os.remove(dst)
+
+    def is_staging(self, path):
+        staging = os.path.join(self.root, STAGING_DIR_NAME)
+        return path == staging or path.startswith(staging + "/")
+
+    def mkstemp(self, directory=None):
+        if directory is None:
+            directory = self.path
+        handle, path = tempfile.mkstemp(".tmp", scratch_prefix(), directory)
+        os.close(handle)
+        return path
+
+    def clone(self, fsrc, fdst):
+        try:
+            fcntl.ioctl(fdst, FICLONE, fsrc)
+            return "reflink"
+        except (IOError, OSError):
+            pass
+        if copy_file_range is not None:
+            try:
+                while copy_file_range(fsrc, fdst, 1 << 30) > 0:
+                    pass
+                return "copy_file_range"
+            except OSError as why:
+                if not why.errno in (EXDEV, ENOSYS, EINVAL, EOPNOTSUPP, EPERM):
+                    raise
+                os.lseek(fsrc, 0, 0)
+                os.lseek(fdst, 0, 0)
+                os.ftruncate(fdst, 0)
+        while True:
+            data = os.read(fsrc, 1024 * 1024)
+            if not data:
+                return "copy"
+            while data:
+                data = data[os.write(fdst, data):]
+
+    def copy(self, src, dst):
+        # same result as shutil.copy2, by the cheapest available means
+        fsrc = os.open(src, os.O_RDONLY)
+        try:
+            fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                strategy = self.clone(fsrc, fdst)
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        shutil.copystat(src, dst)
+        with self.lock:
+            self.strategies[strategy] = self.strategies.get(strategy, 0) + 1
+        logger.debug("snapshot " + src + " to " + dst + " by " + strategy)
+        return strategy
+
+    def commit(self, src, dst, durable=True):
+        # replace dst by src atomically, copying only across devices or when
+        # a rename would split dst from its other hard links
+        try:
+            st = os.stat(dst)
+        except OSError:
+            st = None
+        strategy = "copy"
+        if st is None or st.st_nlink == 1:
+            try:
+                if st is not None:
+                    self.preserve_attributes(src, st)
+                    if durable:
+                        # never replace data by a file that may still be
+                        # empty on disk after a crash, others are synced
+                        # as the policy says, like writes to the original
+                        self.sync_file(src)
+                os.rename(src, dst)
+                strategy = "rename"
+            except OSError as why:
+                if why.errno != EXDEV:
+                    raise
+        if strategy == "copy":
+            self.copy(src, dst)
+        elif durable:
+            self.sync_directory(dst)
+        with self.lock:
+            self.commits[strategy] += 1
+        logger.debug("commit " + src + " to " + dst + " by " + strategy)
+        return strategy
+
+    def preserve_attributes(self, path, st):
+        try:
+            os.chown(path, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+        os.chmod(path, st.st_mode & 07777)
+
+    def sync_file(self, path):
+        handle = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+
+    def sync_directory(self, path):
+        try:
+            handle = os.open(os.path.dirname(path), os.O_RDONLY)
+            try:
+                os.fsync(handle)
+            finally:
+                os.close(handle)
+        except OSError as why:
+            logger.error("directory sync error " + str(why))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.strategies)
+            stats["commits"] = dict(self.commits)
+        stats["path"] = self.path
+        stats["commit_path"] = self.commit_path
+        stats["cloning"] = self.cloning
+        return stats
+
+
+def scratch_prefix():
+    # the pid tells startup reclamation whether the owner is still alive
+    return "mydlpep-" + str(os.getpid()) + "-"
+
+
+class ScratchFile():
+
+    def __init__(self, manager, fd, tier, name=None):
+        self.manager = manager
+        self.fd = fd
+        self.tier = tier
+        self.name = name
+        self.reserved = 0
+        self.refs = 1
+
+    def proc_path(self):
+        return "/proc/" + str(os.getpid()) + "/fd/" + str(self.fd)
+
+    def to_string(self):
+        return self.tier + ":" + str(self.fd)
+
+
+class ScratchManager():
+
+    # staged content lives in memfd buffers while small, in tmpfs while
+    # medium and spills to anonymous files in TMP_PATH when large
+    TIERS = ("memfd", "tmpfs", "disk")
+
+    def __init__(self, staging, budget=None):
+        self.staging = staging
+        if budget is None:
+            budget = SCRATCH_BUDGET
+        self.budget = budget
+        self.used = 0
+        self.condition = Condition()
+        self.counters = {"memfd": 0, "tmpfs": 0, "disk": 0, "spills": 0,
+                         "waits": 0, "starved": 0, "reclaimed": 0}
+
+    def setup(self):
+        for directory in (TMP_PATH, SCRATCH_TMPFS_PATH):
+            if os.path.isdir(directory):
+                self.reclaim(directory)
+
+    def reclaim(self, directory):
+        for name in os.listdir(directory):
+            if not name.startswith("mydlpep-"):
+                continue
+            try:
+                os.kill(int(name.split("-")[1]), 0)
+                continue
+            except (ValueError, IndexError):
+                pass
+            except OSError as why:
+                if why.errno != ESRCH:
+                    continue
+            try:
+                os.remove(os.path.join(directory, name))
+                self.counters["reclaimed"] += 1
+            except OSError as why:
+                logger.error("scratch reclaim error " + str(why))
+
+    def tier_for(self, size):
+        if size <= SCRATCH_MEMORY_LIMIT:
+            return "memfd"
+        if size <= SCRATCH_TMPFS_LIMIT:
+            return "tmpfs"
+        return "disk"
+
+    def open_tier(self, tier):
+        try:
+            if tier == "memfd":
+                if memfd_create is None:
+                    return None
+                return ScratchFile(self, memfd_create("mydlpep"), tier)
+            if tier == "tmpfs":
+                if not os.path.isdir(SCRATCH_TMPFS_PATH):
+                    return None
+                return ScratchFile(self, os.open(SCRATCH_TMPFS_PATH,
+                                        O_TMPFILE | os.O_RDWR, 0600), tier)
+        except OSError as why:
+            logger.debug("scratch " + tier + " unavailable " + str(why))
+            return None
+        try:
+            return ScratchFile(self, os.open(self.staging.path,
+                                        O_TMPFILE | os.O_RDWR, 0600), tier)
+        except OSError:
+            # filesystems without O_TMPFILE get a named file
+            name = self.staging.mkstemp()
+            return ScratchFile(self, os.open(name, os.O_RDWR), tier, name)
+
+    def reserve(self, scratch, size):
+        with self.condition:
+            if size > scratch.reserved:
+                deadline = time.time() + SCRATCH_WAIT
+                waited = False
+                while self.used + size - scratch.reserved > self.budget:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.counters["starved"] += 1
+                        return False
+                    waited = True
+                    self.condition.wait(remaining)
+                if waited:
+                    self.counters["waits"] += 1
+            self.used += size - scratch.reserved
+            scratch.reserved = size
+            self.condition.notify_all()
+            return True
+
+    def unreserve(self, scratch):
+        self.reserve(scratch, 0)
+
+    def allocate(self, size, tier=None):
+        if tier is None:
+            tier = self.tier_for(size)
+        scratch = None
+        while scratch is None:
+            scratch = self.open_tier(tier)
+            if scratch is not None and tier != "disk":
+                if not self.reserve(scratch, size):
+                    # the budget is shared, a smaller tier would not help
+                    self.release(scratch)
+                    scratch = None
+                    tier = "disk"
+                    continue
+            if tier != "disk":
+                tier = self.TIERS[self.TIERS.index(tier) + 1]
+        self.counters[scratch.tier] += 1
+        os.ftruncate(scratch.fd, size)
+        return scratch
+
+    def resize(self, scratch, size, extents):
+        if scratch.tier == "disk":
+            return
+        tier = self.tier_for(size)
+        if self.TIERS.index(tier) <= self.TIERS.index(scratch.tier):
+            if self.reserve(scratch, size):
+                return
+            tier = "disk"
+        # grown out of its tier or out of budget, move the dirty ranges
+        spilled = self.allocate(size, tier)
+        try:
+            for start, end in extents:
+                copy_range(scratch.fd, spilled.fd, start, min(end, size))
+        except:
+            self.release(spilled)
+            raise
+        self.replace(scratch, spilled)
+        self.counters["spills"] += 1
+
+    def replace(self, scratch, other):
+        self.unreserve(scratch)
+        self.close(scratch)
+        scratch.fd = other.fd
+        scratch.tier = other.tier
+        scratch.name = other.name
+        scratch.reserved = other.reserved
+
+    def link(self, scratch):
+        # a named file next to the original, so that commit is a rename
+        if (scratch.name is not None and
+                os.path.dirname(scratch.name) == self.staging.commit_path):
+            name = scratch.name
+            scratch.name = None
+            return name
+        return self.export(scratch, self.staging.commit_path)
+
+    def export(self, scratch, directory=None):
+        # a named copy, or another name of a disk scratch file
+        name = self.staging.mkstemp(directory)
+        if scratch.tier == "disk":
+            try:
+                os.remove(name)
+                link_descriptor(scratch.fd, name)
+                return name
+            except OSError as why:
+                logger.debug("scratch link error " + str(why))
+                open(name, "w").close()
+        fdst = os.open(name, os.O_WRONLY)
+        try:
+            os.lseek(scratch.fd, 0, 0)
+            self.staging.clone(scratch.fd, fdst)
+        finally:
+            os.close(fdst)
+        return name
+
+    def expose(self, scratch):
+        # a named copy for the engine, in memory unless the content already
+        # spilled to disk
+        if scratch.tier == "disk":
+            return self.export(scratch)
+        if not os.path.isdir(SCRATCH_TMPFS_PATH):
+            raise IOError(ENOENT, "no tmpfs for inspection copies",
+                          SCRATCH_TMPFS_PATH)
+        return self.export(scratch, SCRATCH_TMPFS_PATH)
+
+    def close(self, scratch):
+        os.close(scratch.fd)
+        if scratch.name is not None:
+            try:
+                os.remove(scratch.name)
+            except OSError as why:
+                logger.error("scratch cleanup error " + str(why))
+            scratch.name = None
+
+    def retain(self, scratch):
+        # another owner, e.g. an inspection that outlives the commit
+        with self.condition:
+            scratch.refs += 1
+
+    def release(self, scratch):
+        with self.condition:
+            scratch.refs -= 1
+            if scratch.refs > 0:
+                return
+        self.unreserve(scratch)
+        self.close(scratch)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["used"] = self.used
+        stats["budget"] = self.budget
+        return stats
+
+
+class ExtentSet():
+
+    # sorted, disjoint and non adjacent [start, end) ranges
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def truncate(self, length):
+        i = bisect_left(self.starts, length)
+        del self.starts[i:]
+        del self.ends[i:]
+        if self.ends and self.ends[-1] > length:
+            self.ends[-1] = length
+
+    def segments(self, start, end):
+        # (start, end, dirty) pieces covering [start, end)
+        i = bisect_right(self.ends, start)
+        while start < end:
+            if i < len(self.starts) and self.starts[i] <= start:
+                stop = min(self.ends[i], end)
+                dirty = True
+                i += 1
+            else:
+                if i < len(self.starts):
+                    stop = min(self.starts[i], end)
+                else:
+                    stop = end
+                dirty = False
+            yield start, stop, dirty
+            start = stop
+
+    def total(self):
+        return sum(end - start for start, end in self)
+
+
+class WriteBuffers():
+
+    # memory held by the write behind buffers of all handles, a handle that
+    # cannot reserve more writes through instead of waiting
+    def __init__(self, size, budget):
+        self.size = size
+        self.budget = budget
+        self.lock = Lock()
+        self.used = 0
+        self.counters = {"writes": 0, "direct": 0, "flushes": 0,
+                         "bytes": 0}
+        self.reasons = {}
+
+    def reserve(self, count):
+        with self.lock:
+            if self.used + count > self.budget:
+                self.counters["direct"] += 1
+                return False
+            self.used += count
+            self.counters["writes"] += 1
+            return True
+
+    def unreserve(self, count):
+        with self.lock:
+            self.used -= count
+
+    def write_through(self):
+        with self.lock:
+            self.counters["direct"] += 1
+
+    def flushed(self, reason, count):
+        with self.lock:
+            self.counters["flushes"] += 1
+            self.counters["bytes"] += count
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["reasons"] = dict(self.reasons)
+            stats["used"] = self.used
+        stats["budget"] = self.budget
+        # buffered callbacks per write to the scratch file
+        stats["coalescing"] = round(float(stats["writes"]) /
+                                    max(stats["flushes"], 1), 2)
+        return stats
+
+
+class SyncPolicy():
+
+    def __init__(self, on_flush, on_release):
+        self.on_flush = on_flush
+        self.on_release = on_release
+        self.lock = Lock()
+        self.counters = {"flush": 0, "fsync": 0, "release": 0, "synced": 0,
+                         "skipped": 0}
+
+    def count(self, *names):
+        with self.lock:
+            for name in names:
+                self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["on_flush"] = self.on_flush
+        stats["on_release"] = self.on_release
+        return stats
+
+
+class ActiveFile():
+
+    def __init__(self, path, context, fh, is_newly_created):
+        self.path = path
+        self.scratch = None
+        self.context = context
+        self.changed = False
+        self.newly_created = is_newly_created
+        self.recovery = None
+        self.lock = Lock()
+        self.read_lock = Lock()
+        self.fh = fh
+        self.reader = None
+        self.mode = 0
+        self.flags = 0
+        self.extents = ExtentSet()
+        self.base_size = 0
+        self.size = 0
+        self.digest = None
+        self.digest_offset = 0
+        self.stream = None
+        self.buffers = None
+        self.pending = bytearray()
+        self.pending_offset = 0
+        # how the original changed since its last fsync, None when clean
+        self.unsynced = None
+        self.committing = None
+        # the inspection holding the path until this flush committed
+        self.inspection = None
+
+    def update_stream(self, data, offset):
+        if self.stream is not None and not self.stream.feed(data, offset):
+            self.stream = None
+
+    def abort_stream(self):
+        if self.stream is not None:
+            self.stream.abort()
+            self.stream = None
+
+    def reset_digest(self):
+        self.digest = hashlib.sha256()
+        self.digest_offset = 0
+
+    def update_digest(self, data, offset):
+        if self.digest is None:
+            return
+        if offset != self.digest_offset:
+            # only a single sequential pass from offset 0 can be hashed
+            self.digest = None
+            return
+        self.digest.update(data)
+        self.digest_offset += len(data)
+
+    def content_digest(self, size):
+        if self.digest is None or self.digest_offset != size:
+            return None
+        return self.digest.hexdigest()
+
+    def readinto(self, buf, offset):
+        # callers hold read_lock
+        if hasattr(os, "preadv"):
+            return os.preadv(self.fh, [buf], offset)
+        if self.reader is None:
+            self.reader = FileIO(self.fh, "r", closefd=False)
+        os.lseek(self.fh, offset, 0)
+        return self.reader.readinto(buf)
+
+    def create_overlay(self, scratch, buffers=None):
+        # writes land in a sparse scratch file, the rest comes from the
+        # original until inspection needs the whole content
+        self.base_size = self.size = os.fstat(self.fh).st_size
+        self.scratch = scratch.allocate(self.size)
+        self.extents = ExtentSet()
+        self.buffers = buffers
+
+    def write_overlay(self, data, offset):
+        buffers = self.buffers
+        count = len(data)
+        if buffers is None or count >= buffers.size:
+            if buffers is not None:
+                buffers.write_through()
+            self.flush_pending("bypass")
+            return self.write_scratch(data, offset)
+        if self.pending and offset != self.pending_offset + len(self.pending):
+            self.flush_pending("seek")
+        if len(self.pending) + count > buffers.size:
+            self.flush_pending("full")
+        if not buffers.reserve(count):
+            self.flush_pending("pressure")
+            return self.write_scratch(data, offset)
+        if not self.pending:
+            self.pending_offset = offset
+        # copies, fuse reuses the buffer behind a zero copy write
+        self.pending += data
+        return count
+
+    def write_scratch(self, data, offset):
+        end = offset + len(data)
+        if end > self.size:
+            self.scratch.manager.resize(self.scratch, end, self.extents)
+        written = pwrite(self.scratch.fd, data, offset)
+        self.extents.add(offset, offset + written)
+        self.size = max(self.size, offset + written)
+        return written
+
+    def flush_pending(self, reason):
+        # callers hold lock
+        if not self.pending:
+            return
+        data = memoryview(self.pending)
+        offset = self.pending_offset
+        self.buffers.flushed(reason, len(data))
+        try:
+            while data:
+                written = self.write_scratch(data, offset)
+                if written <= 0:
+                    raise IOError(EIO, "short write to scratch")
+                data = data[written:]
+                offset += written
+        finally:
+            data = None
+            self.discard_pending()
+
+    def discard_pending(self):
+        if self.pending:
+            self.buffers.unreserve(len(self.pending))
+            self.pending = bytearray()
+
+    def logical_size(self):
+        # buffered writes count, the kernel already saw them succeed
+        if self.pending:
+            return max(self.size, self.pending_offset + len(self.pending))
+        return self.size
+
+    def getattr(self):
+        # callers hold lock
+        attrs = stat_attributes(os.fstat(self.fh))
+        if self.changed:
+            st = os.fstat(self.scratch.fd)
+            attrs['st_size'] = self.logical_size()
+            attrs['st_mtime'] = max(attrs['st_mtime'], st.st_mtime)
+            attrs['st_ctime'] = max(attrs['st_ctime'], st.st_ctime)
+        return attrs
+
+    def truncate_overlay(self, length):
+        self.flush_pending("truncate")
+        self.scratch.manager.resize(self.scratch, length, self.extents)
+        os.ftruncate(self.scratch.fd, length)
+        self.extents.truncate(length)
+        self.base_size = min(self.base_size, length)
+        self.size = length
+        if length < self.digest_offset:
+            # the hashed prefix is gone, only an empty file can start over
+            if length == 0:
+                self.reset_digest()
+            else:
+                self.digest = None
+
+    def read_overlay(self, size, offset):
+        self.flush_pending("read")
+        chunks = []
+        for start, end, dirty in self.extents.segments(offset,
+                                            min(offset + size, self.size)):
+            if not dirty and start < self.base_size:
+                original = min(end, self.base_size) - start
+                chunks.append(pread(self.fh, original, start).ljust(original,
+                                                                    "\0"))
+                start += original
+            if start < end:
+                chunks.append(pread(self.scratch.fd, end - start, start))
+        return "".join(chunks)
+
+    def materialize(self, staging):
+        self.flush_pending("sync")
+        gaps = [(start, end) for start, end, dirty in
+                self.extents.segments(0, self.base_size) if not dirty]
+        if not gaps:
+            return
+        missing = sum(end - start for start, end in gaps)
+        manager = self.scratch.manager
+        fsrc = os.open(self.path, os.O_RDONLY)
+        try:
+            if (staging.cloning and self.scratch.tier == "disk" and
+                    missing > self.extents.total()):
+                # cloning the original and patching the dirty ranges in
+                # moves less data than filling the gaps
+                clone = manager.open_tier("disk")
+                try:
+                    staging.clone(fsrc, clone.fd)
+                    os.ftruncate(clone.fd, self.size)
+                    for start, end in self.extents:
+                        copy_range(self.scratch.fd, clone.fd, start, end)
+                except:
+                    manager.release(clone)
+                    raise
+                manager.replace(self.scratch, clone)
+            else:
+                for start, end in gaps:
+                    copy_range(fsrc, self.scratch.fd, start, end)
+        finally:
+            os.close(fsrc)
+        self.extents.add(0, self.size)
+        logger.debug("materialized " + str(missing) + " bytes " +
+                     self.to_string())
+
+    def release_scratch(self):
+        self.discard_pending()
+        if self.scratch is not None:
+            try:
+                self.scratch.manager.release(self.scratch)
+            except (IOError, os.error) as why:
+                errors = str(why) + " " + self.to_string() 
+                logger.error("release_scratch error" + errors)     
+            self.scratch = None
+   
+    def scratch_to_string(self):
+        if self.scratch is None:
+            return "None"
+        return self.scratch.to_string()
+
+    def to_string(self):
+        uid, gid, pid = self.context
+        return ("uid:" + str(uid) + " gid:" + str(gid) + " pid:" + 
+                str(pid) +  " path:" + self.path + " scratch:" +
+                self.scratch_to_string() + " fh:" + str(self.fh) +
+                " changed :" + str(self.changed))
+   
+
+class RecoverySnapshot():
+
+    def __init__(self, registry, path):
+        self.registry = registry
+        self.path = path
+        self.file = None
+        self.refs = 0
+        self.lock = Lock()
+
+
+class RecoveryRegistry():
+
+    def __init__(self, staging):
+        self.staging = staging
+        self.lock = Lock()
+        self.snapshots = {}
+        self.created = 0
+        self.shared = 0
+
+    def acquire(self, path):
+        # handles of the same path share one snapshot until it is released
+        with self.lock:
+            snapshot = self.snapshots.get(path)
+            if snapshot is None:
+                snapshot = RecoverySnapshot(self, path)
+                self.snapshots[path] = snapshot
+            else:
+                self.shared += 1
+            snapshot.refs += 1
+        try:
+            with snapshot.lock:
+                if snapshot.file is None:
+                    # snapshots hold content already on the device, next to
+                    # it a rollback is a rename and the copy can be a clone
+                    recovery_file = self.staging.mkstemp(
+                                                    self.staging.commit_path)
+                    self.staging.copy(path, recovery_file)
+                    snapshot.file = recovery_file
+                    self.created += 1
+        except:
+            self.release(snapshot)
+            raise
+        return snapshot
+
+    def retain(self, snapshot):
+        # another owner, e.g. a background commit that outlives the handle
+        with self.lock:
+            snapshot.refs += 1
+        return snapshot
+
+    def release(self, snapshot):
+        with self.lock:
+            snapshot.refs -= 1
+            if snapshot.refs > 0:
+                return
+            if self.snapshots.get(snapshot.path) is snapshot:
+                del self.snapshots[snapshot.path]
+        if snapshot.file is not None:
+            try:
+                os.remove(snapshot.file)
+            except (IOError, os.error) as why:
+                logger.error("recovery cleanup error " + str(why))
+
+    def restore(self, snapshot):
+        # the last holder can hand its snapshot back, others still need it
+        with self.lock:
+            owned = snapshot.refs == 1
+        with snapshot.lock:
+            if snapshot.file is None:
+                # already handed back by an earlier restore
+                return None
+            if owned:
+                strategy = self.staging.commit(snapshot.file, snapshot.path)
+                if strategy == "rename":
+                    snapshot.file = None
+            else:
+                self.staging.copy(snapshot.file, snapshot.path)
+                strategy = "copy"
+        return strategy
+
+    def invalidate(self, path):
+        # after a commit later handles need a snapshot of the new content
+        with self.lock:
+            self.snapshots.pop(path, None)
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.snapshots), "created": self.created,
+                    "shared": self.shared}
+
+
+class ClassifierRule():
+
+    def __init__(self, name, action="allow", glob=None, extension=None,
+                 magic=None, min_size=None, max_size=None, trust_name=False):
+        if not action in ("allow", "inspect"):
+            raise ValueError("unknown action " + action + " in " + name)
+        self.name = name
+        self.action = action
+        # globs with a slash match the path below the mount, others the name
+        globs = split_list(glob)
+        self.name_pattern = compile_globs([g for g in globs if not "/" in g])
+        self.path_pattern = compile_globs([g for g in globs if "/" in g])
+        self.globbed = len(globs) > 0
+        self.extensions = None
+        if extension is not None:
+            self.extensions = frozenset("." + e.lower().lstrip(".")
+                                        for e in split_list(extension))
+        self.magic = None
+        if magic is not None:
+            self.magic = tuple(m.replace(" ", "").decode("hex")
+                               for m in split_list(magic))
+        self.min_size = min_size
+        self.max_size = max_size
+        if (action == "allow" and (self.globbed or extension is not None) and
+                (max_size is None or (magic is None and not trust_name))):
+            raise ValueError("allow rule " + name + " matches names but " +
+                             "lacks max_size, or magic and trust_name")
+
+    def magic_length(self):
+        if self.magic is None:
+            return 0
+        return max(len(m) for m in self.magic)
+
+    def matches(self, relpath, size, head):
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        name = relpath.rpartition("/")[2]
+        if (self.extensions is not None and
+                not os.path.splitext(name)[1].lower() in self.extensions):
+            return False
+        if self.globbed and not (
+                (self.name_pattern is not None and
+                 self.name_pattern.match(name)) or
+                (self.path_pattern is not None and
+                 self.path_pattern.match(relpath))):
+            return False
+        if self.magic is not None:
+            data = head()
+            return any(data.startswith(m) for m in self.magic)
+        return True
+
+
+def split_list(value):
+    if value is None:
+        return []
+    return [item for item in re.split(r"[,\s]+", value.strip()) if item]
+
+
+def compile_globs(globs):
+    if not globs:
+        return None
+    return re.compile("|".join("(?:" + fnmatch.translate(g) + ")"
+                               for g in globs))
+
+
+def load_rules(fp):
+    parser = ConfigParser.RawConfigParser()
+    parser.readfp(fp)
+    rules = []
+    for section in parser.sections():
+        options = dict(parser.items(section))
+        for key in ("min_size", "max_size"):
+            if key in options:
+                options[key] = int(options[key], 0)
+        if "trust_name" in options:
+            options["trust_name"] = parser.getboolean(section, "trust_name")
+        rules.append(ClassifierRule(section, **options))
+    return rules
+
+
+class PreClassifier():
+
+    # decides trivial writes, lock files, os metadata and the like, from a
+    # rule snapshot that is reloaded when its file changes
+    def __init__(self, root, path, enabled=True):
+        self.root = root
+        self.path = path
+        self.enabled = enabled
+        self.lock = Lock()
+        self.rules = []
+        self.head_length = 0
+        self.snapshot = None
+        self.counters = {"skipped": 0, "forced": 0, "passed": 0,
+                         "reloads": 0, "errors": 0}
+        self.hits = {}
+
+    def refresh(self):
+        try:
+            snapshot = os.stat(self.path).st_mtime
+        except OSError:
+            snapshot = "builtin"
+        if snapshot == self.snapshot:
+            return
+        try:
+            if snapshot == "builtin":
+                rules = load_rules(StringIO(PRECLASSIFIER_DEFAULTS))
+            else:
+                with open(self.path) as fp:
+                    rules = load_rules(fp)
+        except (IOError, ConfigParser.Error, ValueError, TypeError) as why:
+            # keep deciding by the previous snapshot
+            logger.error("preclassifier rules error " + str(why))
+            with self.lock:
+                self.counters["errors"] += 1
+            return
+        with self.lock:
+            self.rules = rules
+            self.head_length = max([r.magic_length() for r in rules] + [0])
+            self.snapshot = snapshot
+            self.counters["reloads"] += 1
+        logger.info("preclassifier loaded " + str(len(rules)) + " rules from " +
+                    (self.path if snapshot != "builtin" else "defaults"))
+
+    def classify(self, path, scratch, size):
+        # returns the action of the first matching rule, None when no rule
+        # matches and the engine decides as usual
+        if not self.enabled:
+            return None
+        with self.lock:
+            rules = self.rules
+            head_length = self.head_length
+        relpath = path[len(self.root):].lstrip("/")
+        head = []
+
+        def read_head():
+            if not head:
+                head.append(pread(scratch.fd, min(head_length, size), 0))
+            return head[0]
+
+        for rule in rules:
+            if rule.matches(relpath, size, read_head):
+                with self.lock:
+                    if rule.action == "allow":
+                        self.counters["skipped"] += 1
+                    else:
+                        self.counters["forced"] += 1
+                    self.hits[rule.name] = self.hits.get(rule.name, 0) + 1
+                return rule.action
+        with self.lock:
+            self.counters["passed"] += 1
+        return None
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["hits"] = dict(self.hits)
+            stats["rules"] = len(self.rules)
+        stats["enabled"] = self.enabled
+        return stats
+
+
+class VerdictCache():
+
+    def __init__(self, size, ttl, store=None):
+        self.size = size
+        self.ttl = ttl
+        self.store = store
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[1] < time.time():
+                self.dirty = True
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, allowed):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (allowed, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(False)
+                self.evictions += 1
+            self.dirty = True
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+    def read_store(self):
+        entries = {}
+        try:
+            for line in open(self.store):
+                parts = line.split()
+                if len(parts) != 6:
+                    continue
+                digest, size, uid, dest, allowed, expires = parts
+                entries[(digest, int(size), int(uid), dest)] = \
+                        (allowed == "allow", float(expires))
+        except (IOError, ValueError) as why:
+            logger.debug("verdict cache store not read " + str(why))
+        return entries
+
+    def load(self):
+        if self.store is None:
+            return
+        now = time.time()
+        entries = self.read_store()
+        with self.lock:
+            for key, entry in sorted(entries.items(), key=lambda e: e[1][1]):
+                if entry[1] > now and not key in self.entries:
+                    self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(False)
+        logger.info("verdict cache loaded " + str(len(self.entries)) +
+                    " entries from " + self.store)
+
+    def save(self):
+        if self.store is None or not self.dirty:
+            return
+        # other filter processes share the store, keep their entries too
+        now = time.time()
+        entries = self.read_store()
+        with self.lock:
+            entries.update(self.entries)
+            self.dirty = False
+        entries = sorted([e for e in entries.items() if e[1][1] > now],
+                         key=lambda e: e[1][1])[-self.size:]
+        try:
+            store_handle, store_tmp = tempfile.mkstemp(".tmp", "verdicts-",
+                                        os.path.dirname(self.store))
+            with os.fdopen(store_handle, "w") as f:
+                for (digest, size, uid, dest), (allowed, expires) in entries:
+                    if allowed:
+                        verdict = "allow"
+                    else:
+                        verdict = "block"
+                    f.write(" ".join([digest, str(size), str(uid), dest,
+                                      verdict, repr(expires)]) + "\n")
+            os.rename(store_tmp, self.store)
+        except (IOError, OSError) as why:
+            logger.error("verdict cache save error " + str(why))
+
+
+class AttributeCache():
+
+    # lstat results and ENOENT lookups by path, None caches a missing path
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def token(self):
+        return self.generation
+
+    def get(self, path):
+        # returns (found, attrs)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return False, None
+            self.entries[path] = entry
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def put(self, path, attrs, token):
+        with self.lock:
+            # anything invalidated since the lookup started may be stale
+            if token != self.generation:
+                return
+            self.entries.pop(path, None)
+            self.entries[path] = (attrs, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(False)
+
+    def invalidate(self, path, tree=False):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.entries.pop(path, None)
+            self.entries.pop(os.path.dirname(path), None)
+            if tree:
+                prefix = path + "/"
+                for key in [key for key in self.entries
+                            if key.startswith(prefix)]:
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits,
+                    "negative_hits": self.negative_hits,
+                    "misses": self.misses,
+                    "invalidations": self.invalidations}
+
+
+class DirectoryListing():
+
+    # one per opendir, streams the directory and replays the last window of
+    # entries when fuse resumes at an offset it has already been given
+    def __init__(self, path, hidden=()):
+        self.path = path
+        self.hidden = hidden
+        self.iterator = None
+        self.position = 0
+        self.window = deque(maxlen=DIRECTORY_WINDOW)
+
+    def restart(self):
+        self.close()
+        self.iterator = itertools.chain([".", ".."], scandir(self.path))
+        self.position = 0
+        self.window.clear()
+
+    def item(self, entry):
+        if isinstance(entry, basestring):
+            return entry, {"st_mode": S_IFDIR}
+        # d_type from the directory entry, no stat call
+        if entry.is_symlink():
+            mode = S_IFLNK
+        elif entry.is_dir(follow_symlinks=False):
+            mode = S_IFDIR
+        elif entry.is_file(follow_symlinks=False):
+            mode = S_IFREG
+        else:
+            return entry.name, None
+        return entry.name, {"st_mode": mode}
+
+    def entries(self, offset):
+        if (self.iterator is None or offset > self.position or
+                offset < self.position - len(self.window)):
+            self.restart()
+        for item in list(self.window):
+            if item[2] > offset:
+                yield item
+        for entry in self.iterator:
+            name, attrs = self.item(entry)
+            if name in self.hidden:
+                continue
+            self.position += 1
+            item = (name, attrs, self.position)
+            self.window.append(item)
+            if self.position > offset:
+                yield item
+
+    def close(self):
+        close = getattr(self.iterator, "close", None)
+        if close is not None:
+            close()
+        self.iterator = None
+
+
+class InspectionRejected(IOError):
+    pass
+
+
+class InspectionJob():
+
+    def __init__(self, path, owner, size, func, args):
+        self.path = path
+        self.owner = owner
+        self.size = size
+        self.func = func
+        self.args = args
+        self.queued = time.time()
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class InspectionScheduler():
+
+    def __init__(self, workers, capacity, admission_timeout):
+        self.workers = workers
+        self.capacity = capacity
+        self.admission_timeout = admission_timeout
+        self.cond = Condition(Lock())
+        self.ready = {}
+        self.owners = deque()
+        self.paths = {}
+        self.sequence = 0
+        self.depth = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def make_ready(self, job):
+        # called with the lock held
+        if not job.owner in self.ready:
+            self.ready[job.owner] = []
+            self.owners.append(job.owner)
+        self.sequence += 1
+        heapq.heappush(self.ready[job.owner], (job.size, self.sequence, job))
+        self.cond.notify_all()
+
+    def submit(self, path, owner, size, func, *args):
+        job = InspectionJob(path, owner, size, func, args)
+        deadline = time.time() + self.admission_timeout
+        with self.cond:
+            while self.depth >= self.capacity:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise InspectionRejected("inspection queue is full")
+                self.cond.wait(remaining)
+            self.depth += 1
+            self.submitted += 1
+            # a later flush of the same file waits for the earlier one
+            if path in self.paths:
+                self.paths[path].append(job)
+            else:
+                self.paths[path] = deque([job])
+                self.make_ready(job)
+        return job
+
+    def take(self):
+        # called with the lock held, round robin over owners, smallest first
+        owner = self.owners.popleft()
+        jobs = self.ready[owner]
+        size, sequence, job = heapq.heappop(jobs)
+        if len(jobs) > 0:
+            self.owners.append(owner)
+        else:
+            del self.ready[owner]
+        return job
+
+    def work(self):
+        while True:
+            with self.cond:
+                while len(self.owners) == 0:
+                    self.cond.wait()
+                job = self.take()
+                self.depth -= 1
+                self.running += 1
+                waited = time.time() - job.queued
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.cond.notify_all()
+            try:
+                job.result = job.func(*job.args)
+            except Exception as why:
+                job.error = why
+            with self.cond:
+                self.running -= 1
+            job.done.set()
+
+    def complete(self, job):
+        # the caller committed or rolled back the verdict, a later flush of
+        # the path may be inspected now
+        with self.cond:
+            jobs = self.paths[job.path]
+            jobs.popleft()
+            if len(jobs) > 0:
+                self.make_ready(jobs[0])
+            else:
+                del self.paths[job.path]
+
+    def stats(self):
+        with self.cond:
+            wait_avg = 0.0
+            if self.submitted > 0:
+                wait_avg = self.wait_total / self.submitted
+            return {"depth": self.depth, "running": self.running,
+                    "submitted": self.submitted, "rejected": self.rejected,
+                    "wait_avg": wait_avg, "wait_max": self.wait_max}
+
+
+class CommitJob():
+
+    def __init__(self, path, scratch, size, recovery=None):
+        self.path = path
+        self.scratch = scratch
+        self.size = size
+        # content from before a truncating open, put back if the commit fails
+        self.recovery = recovery
+        self.lock = Lock()
+        self.started = False
+        self.committed = False
+        self.durable = False
+        self.synced = False
+        self.strategy = None
+        self.error = None
+        self.done = Event()
+
+    def read(self, size, offset):
+        with self.lock:
+            if self.scratch is None:
+                return None
+            return pread(self.scratch.fd, max(min(size, self.size - offset), 0),
+                         offset)
+
+    def getattr(self):
+        with self.lock:
+            if self.scratch is None:
+                return None
+            attrs = stat_attributes(os.lstat(self.path))
+            st = os.fstat(self.scratch.fd)
+        attrs['st_size'] = self.size
+        attrs['st_mtime'] = max(attrs['st_mtime'], st.st_mtime)
+        attrs['st_ctime'] = max(attrs['st_ctime'], st.st_ctime)
+        return attrs
+
+    def release(self):
+        with self.lock:
+            if self.scratch is not None:
+                self.scratch.manager.release(self.scratch)
+                self.scratch = None
+            if self.recovery is not None:
+                self.recovery.registry.release(self.recovery)
+                self.recovery = None
+
+
+class BackgroundCommitter():
+
+    # allowed files of one mount, so of one device, are committed by a few
+    # workers, in flush order per path, while reads are served from scratch
+    def __init__(self, device, workers, capacity, commit, sync, rollback):
+        self.device = device
+        self.workers = workers
+        self.capacity = capacity
+        self.commit = commit
+        self.sync = sync
+        self.rollback = rollback
+        self.background = COMMIT_BACKGROUND
+        self.cond = Condition(Lock())
+        self.queue = deque()
+        self.pending = {}
+        self.active = set()
+        self.depth = 0
+        self.bytes_pending = 0
+        self.counters = {"submitted": 0, "committed": 0, "superseded": 0,
+                         "cancelled": 0, "errors": 0, "waits": 0}
+
+    def start(self):
+        for i in range(self.workers):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, job):
+        with self.cond:
+            while self.depth >= self.capacity:
+                self.cond.wait()
+            # a queued job of the same path is overwritten by this one
+            previous = self.pending.get(job.path)
+            if previous is not None and not previous.started:
+                self.discard(previous)
+                self.counters["superseded"] += 1
+            self.pending[job.path] = job
+            self.queue.append(job)
+            self.depth += 1
+            self.bytes_pending += job.size
+            self.counters["submitted"] += 1
+            self.cond.notify_all()
+
+    def discard(self, job):
+        # called with the lock held
+        self.queue.remove(job)
+        self.finish(job)
+        job.committed = True
+        job.release()
+        job.done.set()
+
+    def finish(self, job):
+        # called with the lock held
+        self.depth -= 1
+        self.bytes_pending -= job.size
+        if self.pending.get(job.path) is job:
+            del self.pending[job.path]
+        self.cond.notify_all()
+
+    def take(self):
+        # called with the lock held, jobs of a path being committed wait
+        for job in self.queue:
+            if not job.path in self.active:
+                self.queue.remove(job)
+                self.active.add(job.path)
+                job.started = True
+                return job
+        return None
+
+    def work(self):
+        while True:
+            with self.cond:
+                job = self.take()
+                while job is None:
+                    self.cond.wait()
+                    job = self.take()
+            strategy = None
+            try:
+                strategy = self.commit(job)
+            except Exception as why:
+                logger.error("background commit error " + str(why) + " " +
+                             job.path)
+                job.error = why
+            with self.cond:
+                job.strategy = strategy
+                job.committed = True
+                durable = job.durable
+            if durable and strategy is not None:
+                try:
+                    self.sync(job.path, strategy)
+                    job.synced = True
+                except (IOError, OSError) as why:
+                    logger.error("background sync error " + str(why) + " " +
+                                 job.path)
+                    job.error = why
+            if job.error is not None:
+                # before later jobs of the path may run
+                try:
+                    self.rollback(job)
+                except (IOError, OSError) as why:
+                    logger.error("background rollback error " + str(why) +
+                                 " " + job.path)
+            job.release()
+            with self.cond:
+                self.active.discard(job.path)
+                self.finish(job)
+                if job.error is None:
+                    self.counters["committed"] += 1
+                else:
+                    self.counters["errors"] += 1
+            job.done.set()
+
+    def make_durable(self, job):
+        # False once committed, the caller then syncs by itself
+        with self.cond:
+            if job.committed:
+                return False
+            job.durable = True
+            return True
+
+    def read(self, path, size, offset):
+        job = self.pending.get(path)
+        if job is None:
+            return None
+        return job.read(size, offset)
+
+    def getattr(self, path):
+        job = self.pending.get(path)
+        if job is None:
+            return None
+        return job.getattr()
+
+    def wait(self, path):
+        # orders operations on a path after its pending commits
+        if not path in self.pending:
+            return
+        with self.cond:
+            self.counters["waits"] += 1
+            while path in self.pending:
+                self.cond.wait()
+
+    def wait_prefix(self, prefix):
+        if not self.pending:
+            return
+        with self.cond:
+            while [path for path in self.pending if path.startswith(prefix)]:
+                self.counters["waits"] += 1
+                self.cond.wait()
+
+    def cancel(self, path):
+        # the path is going away, queued content need not be written
+        if not path in self.pending:
+            return
+        with self.cond:
+            for job in [job for job in self.queue if job.path == path]:
+                self.discard(job)
+                self.counters["cancelled"] += 1
+            while path in self.pending:
+                self.cond.wait()
+
+    def drain(self):
+        with self.cond:
+            while self.depth > 0:
+                self.cond.wait()
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["depth"] = self.depth
+            stats["active"] = len(self.active)
+            stats["bytes_pending"] = self.bytes_pending
+        stats["device"] = self.device
+        return stats
+
+
+class AuditJob():
+
+    # what inspection needs of an ActiveFile, kept past its flush
+    def __init__(self, active_file, size, context):
+        self.path = active_file.path
+        self.scratch = active_file.scratch
+        self.stream = active_file.stream
+        active_file.stream = None
+        self.digest = active_file.content_digest(size)
+        self.size = size
+        self.context = context
+        self.queued = time.time()
+        self.inspection = None
+
+    def content_digest(self, size):
+        return self.digest
+
+    def abort_stream(self):
+        if self.stream is not None:
+            self.stream.abort()
+            self.stream = None
+
+    def to_string(self):
+        uid, gid, pid = self.context
+        return ("uid:" + str(uid) + " gid:" + str(gid) + " pid:" +
+                str(pid) + " path:" + self.path + " scratch:" +
+                self.scratch.to_string() + " size:" + str(self.size))
+
+
+class AuditQueue():
+
+    # inspection of committed writes, the backlog is bounded and flushes
+    # past it are inspected synchronously
+    def __init__(self, enabled, workers, backlog, backlog_bytes, audit):
+        self.enabled = enabled
+        self.workers = workers
+        self.backlog = backlog
+        self.backlog_bytes = backlog_bytes
+        self.audit = audit
+        self.cond = Condition(Lock())
+        self.queue = deque()
+        self.depth = 0
+        self.bytes = 0
+        self.lag_max = 0.0
+        self.counters = {"submitted": 0, "allowed": 0, "blocked": 0,
+                         "degraded": 0, "errors": 0}
+
+    def start(self):
+        if not self.enabled:
+            return
+        for i in range(self.workers):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def admit(self, size):
+        # reserves room for a job, False when the flush has to wait instead
+        if not self.enabled:
+            return False
+        with self.cond:
+            if (self.depth >= self.backlog or
+                    self.bytes + size > self.backlog_bytes):
+                self.counters["degraded"] += 1
+                return False
+            self.depth += 1
+            self.bytes += size
+            return True
+
+    def cancel(self, size):
+        # gives back the room of an admitted job that was never submitted
+        with self.cond:
+            self.depth -= 1
+            self.bytes -= size
+            self.cond.notify_all()
+
+    def submit(self, job):
+        with self.cond:
+            self.queue.append(job)
+            self.counters["submitted"] += 1
+            self.cond.notify()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while len(self.queue) == 0:
+                    self.cond.wait()
+                job = self.queue.popleft()
+            try:
+                outcome = "allowed" if self.audit(job) else "blocked"
+            except Exception as why:
+                logger.error("audit error " + str(why) + " " + job.to_string())
+                outcome = "errors"
+            with self.cond:
+                self.counters[outcome] += 1
+                self.lag_max = max(self.lag_max, time.time() - job.queued)
+                self.depth -= 1
+                self.bytes -= job.size
+                self.cond.notify_all()
 
-import subprocess
-import signal
-import quopri
-import tempfile
-import pwd
+    def drain(self):
+        with self.cond:
+            while self.depth > 0:
+                self.cond.wait()
 
-TMP_PATH = "/var/tmp/mydlp"
-SAFE_MNT_PATH = "/var/tmp/mydlpep/safemount"
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["depth"] = self.depth
+            stats["bytes"] = self.bytes
+            stats["lag_max"] = round(self.lag_max, 3)
+        stats["enabled"] = self.enabled
+        return stats
 
-class ActiveFile():
 
-    def __init__(self, path, context, fh, is_newly_created):
-        self.path = path
-        self.cpath = None
-        self.context = context
-        self.changed = False
-        self.recovery_file = None
-        if not is_newly_created:
-            rpath_handle, self.recovery_file = tempfile.mkstemp(".tmp", "mydlpep-", TMP_PATH)
-            os.close(rpath_handle)
-            shutil.copy2(self.path, self.recovery_file)
-        self.fh = fh
-        self.cfh = 0
-        self.mode = 0
-        self.flags = 0
+class Housekeeper(Thread):
+
+    def __init__(self, interval, stats_path):
+        Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stats_path = stats_path
+        self.stopped = Event()
+        self.sources = []
+        self.tasks = []
+        self.warned = False
+
+    def add_stats(self, name, source):
+        self.sources.append((name, source))
+
+    def add_task(self, task):
+        self.tasks.append(task)
+
+    def write_stats(self):
+        lines = []
+        for name, source in self.sources:
+            for key, value in sorted(source().items()):
+                lines.append(name + "." + key + "\t" + str(value))
+        logger.debug("stats " + " ".join(lines).replace("\t", "="))
+        try:
+            # RUN_PATH is usually on a tmpfs that is empty after boot
+            directory = os.path.dirname(self.stats_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.stats_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+        except (IOError, OSError) as why:
+            if not self.warned:
+                logger.warning("stats not written " + str(why))
+                self.warned = True
+
+    def run_once(self):
+        for task in self.tasks:
+            try:
+                task()
+            except Exception as why:
+                logger.error("housekeeping error " + str(why))
+        self.write_stats()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        self.stopped.set()
+        self.run_once()
+
+
+class SeapError(IOError):
+    pass
+
+
+class SeapUnavailable(SeapError):
+    pass
+
 
-    def create_cpath(self):
-        if self.cpath is None:
-            cpath_handle, self.cpath = tempfile.mkstemp(".tmp", "mydlpep-", TMP_PATH)
-            os.close(cpath_handle)
+def seap_encode(value):
+    # soft line breaks or raw newlines would split a pipelined command
+    return quopri.encodestring(value).replace("=\n", "").replace("\n", "=0A")
 
-    def duplicate_cpath(self):
-        if self.cpath is None:
+
+class SeapConnection():
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self.sock = socket()
+        self.sock.settimeout(SEAP_CONNECT_TIMEOUT)
+        try:
+            self.sock.connect((self.server, self.port))
+        except:
+            self.sock.close()
+            raise
+        self.sock.settimeout(SEAP_TIMEOUT)
+        self.buffer = ""
+        self.pending = 0
+        self.used = False
+        self.last_used = time.time()
+
+    def fill_buffer(self):
+        data = self.sock.recv(4096)
+        if data == "":
+            raise SeapError("Seap connection closed by " + self.server +
+                            ":" + str(self.port))
+        self.buffer += data
+
+    def take_line(self):
+        pos = self.buffer.find("\n")
+        if pos < 0:
             return None
-        cpath2_handle, cpath2 = tempfile.mkstemp(".tmp", "mydlpep-", TMP_PATH)
-        os.close(cpath2_handle)
-        os.remove(cpath2)
-        os.link(self.cpath, cpath2)
-        return cpath2
-
-    def cleanup_cpath(self):
-        if self.cpath is not None:
+        line = self.buffer[:pos].strip()
+        self.buffer = self.buffer[pos + 1:]
+        return line
+
+    def readline(self):
+        line = self.take_line()
+        while line is None:
+            self.fill_buffer()
+            line = self.take_line()
+        logger.debug("[" + line + "]")
+        self.used = True
+        self.last_used = time.time()
+        return line
+
+    def drain(self):
+        while self.pending > 0:
+            self.readline()
+            self.pending -= 1
+
+    def send_chunk(self, opid, chunk, timeout=None):
+        if timeout is None:
+            timeout = SEAP_TIMEOUT
+        self.sock.settimeout(timeout)
+        self.drain()
+        message = "PUSH " + opid + " " + str(len(chunk))
+        logger.debug("<" + message + ">")
+        self.sock.sendall(message + "\r\n")
+        self.sock.sendall(chunk)
+        return self.readline()
+
+    def send(self, message, timeout=None):
+        if timeout is None:
+            timeout = SEAP_TIMEOUT
+        self.sock.settimeout(timeout)
+        self.drain()
+        logger.debug("<" + message + ">")
+        self.sock.sendall(message + "\r\n")
+        return self.readline()
+
+    def pipeline(self, messages, timeout=None):
+        if timeout is None:
+            timeout = SEAP_TIMEOUT
+        self.sock.settimeout(timeout)
+        self.drain()
+        for message in messages:
+            logger.debug("<" + message + ">")
+        self.sock.sendall("".join([message + "\r\n" for message in messages]))
+        return [self.readline() for message in messages]
+
+    def post(self, message):
+        # response is collected by the next send, pipeline or is_alive call
+        logger.debug("<" + message + ">")
+        self.sock.sendall(message + "\r\n")
+        self.pending += 1
+
+    def is_alive(self):
+        # an idle connection may only have responses of posted messages to
+        # read, anything else on the wire means EOF or junk
+        try:
+            while len(select([self.sock], [], [], 0)[0]) > 0:
+                self.fill_buffer()
+            while self.pending > 0:
+                if self.take_line() is None:
+                    break
+                self.pending -= 1
+        except (IOError, OSError, ValueError):
+            return False
+        return self.pending > 0 or self.buffer == ""
+
+    def close(self):
+        try:
+            self.sock.close()
+        except (IOError, OSError):
+            pass
+
+
+class SeapConnectionPool():
+
+    def __init__(self, server, port, size, idle_timeout):
+        self.server = server
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.cond = Condition(Lock())
+        self.idle = []
+        self.opened = 0
+
+    def evict_idle(self):
+        now = time.time()
+        alive = []
+        for conn in self.idle:
+            if now - conn.last_used > self.idle_timeout:
+                logger.debug("Seap pool evicting idle connection")
+                conn.close()
+                self.opened -= 1
+            else:
+                alive.append(conn)
+        self.idle = alive
+
+    def checkout(self):
+        with self.cond:
+            while True:
+                self.evict_idle()
+                while len(self.idle) > 0:
+                    conn = self.idle.pop()
+                    if conn.is_alive():
+                        return conn
+                    logger.debug("Seap pool dropping dead connection")
+                    conn.close()
+                    self.opened -= 1
+                if self.opened < self.size:
+                    self.opened += 1
+                    break
+                self.cond.wait()
+        try:
+            return SeapConnection(self.server, self.port)
+        except:
+            with self.cond:
+                self.opened -= 1
+                self.cond.notify()
+            raise
+
+    def checkin(self, conn, broken=False):
+        with self.cond:
+            if broken:
+                conn.close()
+                self.opened -= 1
+            else:
+                self.idle.append(conn)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            for conn in self.idle:
+                conn.close()
+                self.opened -= 1
+            self.idle = []
+
+
+class SeapLatency():
+
+    def __init__(self):
+        self.lock = Lock()
+        self.base = None
+        self.per_byte = 1.0 / SEAP_MIN_THROUGHPUT
+
+    def observe(self, seconds, size=0):
+        with self.lock:
+            if self.base is None:
+                self.base = seconds
+            elif size < SEAP_MIN_THROUGHPUT:
+                self.base = 0.8 * self.base + 0.2 * seconds
+            else:
+                per_byte = max(0.0, seconds - self.base) / size
+                self.per_byte = 0.8 * self.per_byte + 0.2 * per_byte
+
+    def timeout(self, size=0):
+        # at most the static timeout plus a floor throughput for the payload
+        with self.lock:
+            base, per_byte = self.base, self.per_byte
+        ceiling = SEAP_TIMEOUT + float(size) / SEAP_MIN_THROUGHPUT
+        if base is None:
+            return ceiling
+        estimate = SEAP_TIMEOUT_FACTOR * (base + size * per_byte)
+        return min(ceiling, max(SEAP_MIN_TIMEOUT, estimate))
+
+    def stats(self):
+        with self.lock:
+            return {"latency_base": self.base,
+                    "latency_per_mb": self.per_byte * 1024 * 1024}
+
+
+class CircuitBreaker():
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold, probe_interval, probe):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.probe = probe
+        self.lock = Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.trial = False
+        self.rejected = 0
+        self.trips = 0
+        self.prober = None
+
+    def allow(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def closed(self):
+        # optional traffic such as streams must not take the half-open trial
+        with self.lock:
+            return self.state == CircuitBreaker.CLOSED
+
+    def success(self):
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info("Seap circuit closed")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == CircuitBreaker.HALF_OPEN or
+                    self.failures >= self.threshold):
+                self.trip()
+
+    def trip(self):
+        # called with the lock held
+        if self.state != CircuitBreaker.OPEN:
+            logger.error("Seap circuit opened, failures: " + str(self.failures))
+            self.trips += 1
+        self.state = CircuitBreaker.OPEN
+        self.trial = False
+        if self.prober is None or not self.prober.is_alive():
+            self.prober = Thread(target=self.run_probe)
+            self.prober.daemon = True
+            self.prober.start()
+
+    def force_open(self):
+        with self.lock:
+            self.trip()
+
+    def run_probe(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self.lock:
+                if self.state != CircuitBreaker.OPEN:
+                    return
             try:
-                os.remove(self.cpath)
-            except (IOError, os.error) as why:
-                errors = str(why) + " " + self.to_string() 
-                logger.error("cleanup_cpath error" + errors)     
-            self.cpath = None
-   
-    def cpath_to_string(self):
-        if self.cpath is None:
-            return "None"
-        return self.cpath
+                self.probe()
+            except (IOError, OSError) as why:
+                logger.debug("Seap probe failed " + str(why))
+                continue
+            with self.lock:
+                if self.state == CircuitBreaker.OPEN:
+                    logger.info("Seap circuit half-open")
+                    self.state = CircuitBreaker.HALF_OPEN
+                    self.trial = False
+                return
+
+    def stats(self):
+        with self.lock:
+            return {"breaker_state": self.state, "breaker_trips": self.trips,
+                    "breaker_rejected": self.rejected}
+
+
+class SeapStream():
+
+    def __init__(self, client, userpath, uid):
+        self.client = client
+        self.userpath = userpath
+        self.uid = uid
+        # set up by the feeder, writes never wait for the engine
+        self.conn = None
+        self.opid = None
+        self.offset = 0
+        self.chunks = []
+        self.buffered = 0
+        self.failed = False
+        self.broken = False
+        self.ended = False
+        self.closed = False
+        self.queue = Queue(SEAP_STREAM_QUEUE)
+        self.feeder = Thread(target=self.run)
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def feed(self, data, offset):
+        if self.failed or self.ended:
+            return False
+        if offset != self.offset:
+            logger.debug("Seap stream of " + self.userpath + " got a write " +
+                         "at " + str(offset) + ", expected " + str(self.offset))
+            self.abort()
+            return False
+        if isinstance(data, memoryview):
+            # the fuse buffer is reused as soon as the write returns
+            data = data.tobytes()
+        self.chunks.append(data)
+        self.buffered += len(data)
+        self.offset += len(data)
+        if self.buffered >= SEAP_STREAM_CHUNK and not self.push(False):
+            # the engine falls behind, writes are never held up for it
+            logger.debug("Seap stream of " + self.userpath + " is behind")
+            self.abort()
+            return False
+        return True
+
+    def push(self, block):
+        if self.buffered > 0:
+            try:
+                self.queue.put("".join(self.chunks), block)
+            except Full:
+                return False
+            self.chunks = []
+            self.buffered = 0
+        return True
+
+    def end(self, block):
+        if not self.ended:
+            try:
+                self.queue.put(None, block)
+                self.ended = True
+            except Full:
+                # the feeder stops by itself once failed and drained
+                pass
+
+    def run(self):
+        started = self.client.begin_stream(self.userpath, self.uid)
+        if started is None:
+            self.failed = True
+        else:
+            self.conn, self.opid = started
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if not self.failed:
+                self.send(chunk)
+            if self.failed and self.queue.empty():
+                break
+        if self.failed:
+            self.close()
+
+    def send(self, chunk):
+        try:
+            response = self.conn.send_chunk(self.opid, chunk,
+                                self.client.latency.timeout(len(chunk)))
+            if not response.startswith("OK"):
+                # the engine refuses chunks, later files use PUSHFILE only
+                logger.warning("Seap stream " + self.opid + " refused: " +
+                               response)
+                self.client.streaming = False
+                self.failed = True
+        except IOError as why:
+            # the PUSHFILE retry tells whether the engine itself is down
+            logger.error("Seap stream " + self.opid + " " + str(why))
+            self.failed = True
+            self.broken = True
+
+    def abort(self):
+        self.failed = True
+        self.end(False)
+
+    def finish(self, size):
+        # returns the ACLQ action, None when the path based push is needed
+        if self.offset == size:
+            self.push(True)
+        else:
+            self.failed = True
+        self.end(True)
+        self.feeder.join()
+        if self.failed:
+            return None
+        try:
+            responses = self.conn.pipeline(["END " + self.opid,
+                                            "ACLQ " + self.opid],
+                                           self.client.latency.timeout(size))
+            for response in responses:
+                if not response.startswith("OK"):
+                    logger.warning("Seap stream " + self.opid + " refused: " +
+                                   response)
+                    self.client.streaming = False
+                    return None
+            action = responses[-1].split()[1]
+            self.client.breaker.success()
+            self.client.streamed += 1
+            return action
+        except IOError as why:
+            logger.error("Seap stream " + self.opid + " " + str(why))
+            self.broken = True
+            return None
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.conn is not None:
+            if not self.broken:
+                try:
+                    self.conn.post("DESTROY " + self.opid)
+                except IOError:
+                    self.broken = True
+            self.client.pool.checkin(self.conn, self.broken)
+        self.client.stream_closed()
 
-    def to_string(self):
-        uid, gid, pid = self.context
-        return ("uid:" + str(uid) + " gid:" + str(gid) + " pid:" + 
-                str(pid) +  " path:" + self.path + " cpath:" + self.cpath_to_string() +
-                " fh:" + str(self.fh) + " cfh:" + str(self.cfh) +
-                " changed :" + str(self.changed))
-   
 
 class SeapClient():
 
     def __init__(self, server, port):
         self.server = server
         self.port = port
-        self.sock = socket()
-        self.sock.settimeout(145)
-        self.sock.connect((self.server, self.port))
+        self.pool = SeapConnectionPool(server, port, SEAP_POOL_SIZE,
+                                       SEAP_POOL_IDLE_TIMEOUT)
+        self.latency = SeapLatency()
+        self.breaker = CircuitBreaker(SEAP_BREAKER_THRESHOLD,
+                                      SEAP_PROBE_INTERVAL, self.warm)
+        self.lock = Lock()
+        self.streams = 0
+        self.streamed = 0
+        self.streaming = SEAP_STREAMING
+        self.proc_paths = SEAP_PROC_PATHS
+        self.descriptors = False
+        self.descriptors_checked = 0
+
+    def warm(self):
+        self.pool.checkin(self.pool.checkout())
+
+    def engine_uid(self):
+        # owner of the listening SEAP socket, None unless it is local
+        if not self.server in ("127.0.0.1", "localhost", "::1"):
+            return None
+        port = ":%04X" % self.port
+        for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+            try:
+                with open(table) as lines:
+                    lines.readline()
+                    for line in lines:
+                        fields = line.split()
+                        if fields[3] == "0A" and fields[1].endswith(port):
+                            return int(fields[7])
+            except (IOError, IndexError, ValueError) as why:
+                logger.debug("engine owner lookup " + str(why))
+        return None
 
-    def send(self, message):
-        logger.debug("try to send " + message)
-        for try_count in range(3):        
+    def reads_descriptors(self):
+        # an engine that may not open /proc/<pid>/fd of another user would
+        # judge a file it never read, so ask only root or ourselves
+        if not self.proc_paths:
+            return False
+        now = time.time()
+        with self.lock:
+            if now - self.descriptors_checked < SEAP_PROBE_INTERVAL:
+                return self.descriptors
+        uid = self.engine_uid()
+        readable = uid is not None and uid in (0, os.geteuid())
+        with self.lock:
+            self.descriptors = readable
+            self.descriptors_checked = now
+        return readable
+
+    def connect_in_background(self):
+        def connect():
             try:
-                logger.debug("try count " + str(try_count))
-                self.sock.sendall(message + "\r\n")
-                response = self.sock.recv(1024).strip()
-                logger.debug("<" + message + ">")
-                logger.debug("[" + response + "]")
-                if response == "":
-                    self.sock = socket()
-                    self.sock.settimeout(10)
-                    self.sock.connect((self.server, self.port))
-                else:
-                    return response
+                self.warm()
+                logger.info("Connected to SEAP server " + self.server + ":" +
+                            str(self.port))
+            except (IOError, OSError) as why:
+                logger.error("Cannot connect to SEAP server " + self.server +
+                             ":" + str(self.port) + " " + str(why))
+                self.breaker.force_open()
+        connector = Thread(target=connect)
+        connector.daemon = True
+        connector.start()
+
+    def begin(self):
+        # a pooled connection may have been closed by a restarted server,
+        # so retry with another one, a fresh connection failing is final
+        for try_count in range(SEAP_RETRY_COUNT):
+            logger.debug("try count " + str(try_count))
+            conn = self.pool.checkout()
+            try:
+                started = time.time()
+                response = conn.send("BEGIN", self.latency.timeout())
+                self.latency.observe(time.time() - started)
+                return conn, response
             except IOError as why:
-                logger.error("Seap send IOError" + str(why))
-                #time.sleep(2)
-                self.sock = socket()
-                self.sock.settimeout(10)
-                self.sock.connect((self.server, self.port))
+                logger.error("Seap send IOError " + str(why))
+                self.pool.checkin(conn, True)
+                if not conn.used:
+                    raise
 
-        logger.error("Seap send failed to server" + self.server + ":" +
-                     str(self.port))
-        return ""
+        raise SeapError("Seap send failed to server " + self.server + ":" +
+                        str(self.port))
 
-    def allow_write_by_path(self, path, userpath, context):
-        logger.debug("allow_write_by_path " + userpath)
+    def close(self):
+        self.pool.close()
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats.update(self.latency.stats())
+        with self.pool.cond:
+            stats["pool_opened"] = self.pool.opened
+            stats["pool_idle"] = len(self.pool.idle)
+        stats["streams"] = self.streams
+        stats["streamed"] = self.streamed
+        stats["streaming"] = self.streaming
+        stats["proc_paths"] = self.proc_paths
+        return stats
+
+    def properties(self, opid, userpath, uid):
+        userpathdir, userpathbase = os.path.split(userpath)
+        user_tuple = pwd.getpwuid(uid)
+        username = user_tuple.pw_name
+        return ["SETPROP " + opid + " filename=" + seap_encode(userpathbase),
+                "SETPROP " + opid + " destination=" + seap_encode(userpath),
+                "SETPROP " + opid + " user=" + username.strip()]
+
+    def open_stream(self, userpath, context):
+        with self.lock:
+            if self.streams >= SEAP_STREAM_LIMIT:
+                return None
+            self.streams += 1
+        if not self.breaker.closed():
+            self.stream_closed()
+            return None
+        uid, guid, pid = context
+        return SeapStream(self, userpath, uid)
+
+    def begin_stream(self, userpath, uid):
+        # returns the connection and opid of a stream, None when refused,
+        # failures are left for the PUSHFILE retry to judge
+        conn = None
+        try:
+            conn, response = self.begin()
+            if response.startswith("OK"):
+                opid = response.split()[1]
+                responses = self.query(conn, self.properties(opid, userpath,
+                                                             uid), 0)
+                if len([r for r in responses if not r.startswith("OK")]) == 0:
+                    return conn, opid
+                conn.post("DESTROY " + opid)
+                self.pool.checkin(conn)
+            else:
+                self.pool.checkin(conn, True)
+        except (IOError, OSError, KeyError) as why:
+            logger.error("open_stream " + str(why))
+            if conn is not None:
+                self.pool.checkin(conn, True)
+        return None
+
+    def stream_closed(self):
+        with self.lock:
+            self.streams -= 1
+
+    def query(self, conn, commands, size):
+        timeout = self.latency.timeout(size)
+        started = time.time()
+        if SEAP_PIPELINE:
+            responses = conn.pipeline(commands, timeout)
+        else:
+            responses = []
+            for command in commands:
+                response = conn.send(command, timeout)
+                responses.append(response)
+                if not response.startswith("OK"):
+                    break
+        self.latency.observe(time.time() - started, size)
+        return responses
+
+    def inspect_by_path(self, path, userpath, context, admitted=False,
+                        charge=True):
+        # returns the ACLQ action, None when the engine gave no verdict,
+        # admitted is set for a retry of a request the breaker already let
+        # through and charge is cleared for attempts allowed to be refused
+        size = os.path.getsize(path)
+        if not admitted and not self.breaker.allow():
+            raise SeapUnavailable("Seap circuit is open for " + self.server +
+                                  ":" + str(self.port))
+        conn = None
+        broken = False
         try:
             uid, guid, pid = context
-            response = self.send("BEGIN")
-            if not response.startswith("OK"):
-                return True
-            
-            userpathdir, userpathbase = os.path.split(userpath)
-            opid = response.split()[1]
-            response = self.send("SETPROP " + opid + " filename=" + quopri.encodestring(userpathbase))
+            conn, response = self.begin()
             if not response.startswith("OK"):
-                return True
+                # no opid to destroy, the engine state of this connection
+                # is unknown so it is not reused
+                broken = True
+                if charge:
+                    self.breaker.failure()
+                return None
 
-            response = self.send("SETPROP " + opid + " destination=" + quopri.encodestring(userpath))
-            if not response.startswith("OK"):
-                return True
+            opid = response.split()[1]
+            commands = self.properties(opid, userpath, uid)
+            if not path.startswith("/proc/"):
+                commands.append("SETPROP " + opid + " burn_after_reading=true")
+            responses = self.query(conn, commands + [
+                "PUSHFILE " + opid + " " + seap_encode(path),
+                "END " + opid,
+                "ACLQ " + opid], size)
+            conn.post("DESTROY " + opid)
+            for response in responses:
+                if not response.startswith("OK"):
+                    if charge:
+                        self.breaker.failure()
+                    return None
 
-            response = self.send("SETPROP " + opid + " burn_after_reading=true")
-            if not response.startswith("OK"):
-                return True
-            
-            user_tuple = pwd.getpwuid(uid)
-            username = user_tuple.pw_name
+            action = responses[-1].split()[1]
+            logger.debug("ACLQ " + opid + " " + action)
+            self.breaker.success()
+            return action
+        except (IOError, OSError):
+            broken = True
+            self.breaker.failure()
+            raise
+        finally:
+            if conn is not None:
+                self.pool.checkin(conn, broken)
 
-            response = self.send("SETPROP " + opid + " user=" + username.strip())
-            if not response.startswith("OK"):
-                return True
-            
-            response = self.send("PUSHFILE " + opid + " " + quopri.encodestring(path))
-            if not response.startswith("OK"):
-                return True
-            
-            response = self.send("END " + opid)            
-            if not response.startswith("OK"):
-                return True
-            
-            response = self.send("ACLQ " + opid)
-            if not response.startswith("OK"):
-                return True
-            self.send("DESTROY " + opid)
-            print response.split()[1]
-            if response.split()[1] == "block":
-                return False
-            else:
-                return True
+    def allow_write_by_path(self, path, userpath, context):
+        logger.debug("allow_write_by_path " + userpath)
+        try:
+            return self.inspect_by_path(path, userpath, context) != "block"
         except (IOError, OSError) as why:
             logger.error("allow_write_by_path " + str(why) )
+            return SEAP_FAIL_OPEN
 
 class MyDLPFilter(LoggingMixIn, Operations):
 
     def __init__(self, mount, root):
         self.mount = realpath(mount)
         self.root = realpath(root)
-        self.rwlock = Lock()
         self.files = {}
-        self.seap =  SeapClient("127.0.0.1" , 9099)
+        self.directories = {}
+        self.directory_handles = itertools.count(1)
+        self.log_operations = FUSE_LOG_OPERATIONS
+        self.writeback = writeback_cache()
+        self.staging = StagingArea(self.root)
+        self.staging.setup()
+        self.scratch = ScratchManager(self.staging)
+        self.scratch.setup()
+        self.recoveries = RecoveryRegistry(self.staging)
+        self.seap = SeapClient(SEAP_SERVER, SEAP_PORT)
+        self.verdicts = VerdictCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL,
+                                     VERDICT_CACHE_STORE)
+        self.verdicts.load()
+        self.attributes = AttributeCache(ATTRIBUTE_CACHE_SIZE,
+                                         ATTRIBUTE_CACHE_TTL)
+        self.write_buffers = WriteBuffers(WRITE_BUFFER_SIZE,
+                                          WRITE_BUFFER_BUDGET)
+        self.sync = SyncPolicy(SYNC_ON_FLUSH, SYNC_ON_RELEASE)
+        self.committer = BackgroundCommitter(os.stat(self.root).st_dev,
+                                             COMMIT_WORKERS, COMMIT_QUEUE_SIZE,
+                                             self.commit_staged, self.sync_path,
+                                             self.rollback_commit)
+        self.classifier = PreClassifier(self.root, PRECLASSIFIER_RULES,
+                                        PRECLASSIFIER_ENABLED)
+        self.classifier.refresh()
+        self.auditor = AuditQueue(AUDIT_MODE, AUDIT_WORKERS, AUDIT_BACKLOG,
+                                  min(AUDIT_BACKLOG_BYTES,
+                                      self.scratch.budget / 2),
+                                  self.audit_write)
+        self.housekeeper = Housekeeper(HOUSEKEEPING_INTERVAL, RUN_PATH +
+                                       "/filterfs" + self.mount.replace("/", "-") +
+                                       ".stats")
+        self.scheduler = InspectionScheduler(SCHEDULER_WORKERS,
+                                             SCHEDULER_QUEUE_SIZE,
+                                             SCHEDULER_ADMISSION_TIMEOUT)
+        self.housekeeper.add_stats("seap", self.seap.stats)
+        self.housekeeper.add_stats("scheduler", self.scheduler.stats)
+        self.housekeeper.add_stats("recovery", self.recoveries.stats)
+        self.housekeeper.add_stats("staging", self.staging.stats)
+        self.housekeeper.add_stats("scratch", self.scratch.stats)
+        self.housekeeper.add_stats("verdict_cache", self.verdicts.stats)
+        self.housekeeper.add_stats("attribute_cache", self.attributes.stats)
+        self.housekeeper.add_stats("write_buffer", self.write_buffers.stats)
+        self.housekeeper.add_stats("sync", self.sync.stats)
+        self.housekeeper.add_stats("committer", self.committer.stats)
+        self.housekeeper.add_stats("audit", self.auditor.stats)
+        self.housekeeper.add_stats("preclassifier", self.classifier.stats)
+        self.housekeeper.add_task(self.verdicts.save)
+        self.housekeeper.add_task(self.classifier.refresh)
         logger.info("Started on " + self.root)
-        logger.info("Connecting to SEAP server 127.0.0.1:9099")
+        logger.info("Using SEAP server " + SEAP_SERVER + ":" + str(SEAP_PORT) +
+                    " with " + str(SEAP_POOL_SIZE) + " pooled connections")
 
     def __call__(self, op, path, *args):
-        return super(MyDLPFilter, self).__call__(op, self.root + path, *args)
+        path = self.root + path
+        if self.staging.is_staging(path):
+            raise FuseOSError(ENOENT)
+        return super(MyDLPFilter, self).__call__(op, path, *args)
+
+    def resolve(self, op):
+        # __call__ with the root and staging prefixes looked up once
+        method = super(MyDLPFilter, self).resolve(op)
+        root = self.root
+        is_staging = self.staging.is_staging
+
+        def call(path, *args):
+            path = root + path
+            if is_staging(path):
+                raise FuseOSError(ENOENT)
+            return method(path, *args)
+        return call
 
     def access(self, path, mode):
         if not os.access(path, mode):
             raise FuseOSError(EACCES)
 
-    chmod = os.chmod
-    chown = os.chown
+    def chmod(self, path, mode):
+        self.committer.wait(path)
+        os.chmod(path, mode)
+        self.attributes.invalidate(path)
+
+    def chown(self, path, uid, gid):
+        self.committer.wait(path)
+        os.chown(path, uid, gid)
+        self.attributes.invalidate(path)
 
     def create(self, path, mode):
-        print "CREATE is called with path: " + path
         context = fuse_get_context()
+        if self.writeback:
+            flags = os.O_RDWR | os.O_CREAT
+        else:
+            flags = os.O_WRONLY | os.O_CREAT
         try:
-            fh = os.open(path, os.O_WRONLY | os.O_CREAT, mode)
+            fh = os.open(path, flags, mode)
         except:
             return -EBADF            
+        self.attributes.invalidate(path)
         if not fh in self.files:
             active_file = ActiveFile(path, context, fh, True)
             active_file.mode = mode
-            active_file.flags = os.O_WRONLY | os.O_CREAT
+            active_file.flags = flags
             self.files.update({fh: active_file})
         logger.debug("create "+ self.files[fh].to_string())
         return fh
 
     def destroy(self, private_data):
+        # allowed files still queued are written before the unmount ends
+        self.committer.drain()
+        self.auditor.drain()
+        self.housekeeper.stop()
+        self.seap.close()
+        self.staging.close()
         logger.info("stopped filter mounted on " + mount_point)
 
+    def init(self, path):
+        self.seap.connect_in_background()
+        self.scheduler.start()
+        self.committer.start()
+        self.auditor.start()
+        self.housekeeper.start()
+
+    def inspect(self, active_file, size, context):
+        admitted = False
+        if active_file.stream is not None:
+            stream = active_file.stream
+            active_file.stream = None
+            action = stream.finish(size)
+            if action is not None:
+                logger.debug("streamed inspection " + action + " " +
+                             active_file.to_string())
+                return action
+            # streams only start on a closed circuit, a given up one is
+            # retried by PUSHFILE even if other writers opened it since
+            admitted = True
+
+        userpath = self.get_real_path(active_file.path)
+        refused = False
+        if self.seap.reads_descriptors():
+            # the server reads the scratch file through our descriptor, a
+            # refusal is retried with a copy and not held against the engine
+            action = self.seap.inspect_by_path(
+                                active_file.scratch.proc_path(), userpath,
+                                context, admitted, charge=False)
+            if action is not None:
+                return action
+            admitted = refused = True
+        name = self.scratch.expose(active_file.scratch)
+        try:
+            action = self.seap.inspect_by_path(name, userpath, context,
+                                               admitted)
+        finally:
+            # burnt after reading, unless the engine never got to it
+            try:
+                os.remove(name)
+            except OSError as why:
+                if why.errno != ENOENT:
+                    logger.error("inspection cleanup error " + str(why))
+        if action is not None and refused:
+            logger.warning("Seap server cannot open descriptor paths, "
+                           "sending copies from " + os.path.dirname(name))
+            self.seap.proc_paths = False
+        return action
+
+    def allow_write(self, active_file, size, context):
+        action = self.classifier.classify(active_file.path,
+                                          active_file.scratch, size)
+        if action == "allow":
+            logger.debug("preclassified " + active_file.to_string())
+            active_file.abort_stream()
+            return True
+        key = None
+        digest = active_file.content_digest(size)
+        if digest is not None:
+            key = (digest, size, context[0], DESTINATION_CLASS)
+            allowed = self.verdicts.get(key)
+            if allowed is not None:
+                logger.debug("verdict cache hit " + digest + " " +
+                             active_file.to_string())
+                active_file.abort_stream()
+                return allowed
+
+        uid, gid, pid = context
+        try:
+            # callers complete the inspection once its verdict is applied
+            active_file.inspection = self.scheduler.submit(active_file.path,
+                                        (uid, pid), size, self.inspect,
+                                        active_file, size, context)
+            action = active_file.inspection.wait()
+        except (IOError, OSError) as why:
+            logger.error("allow_write_by_path " + str(why) )
+            return SEAP_FAIL_OPEN
+        if action is None:
+            return True
+        allowed = action != "block"
+        if key is not None:
+            self.verdicts.put(key, allowed)
+        return allowed
+
     def get_real_path(self, path):
         if path.startswith(self.root):
             return self.mount + path[len(self.root):]
         return path
 
-    def handle_flush_sync(self, fh, context):
-        if fh in self.files:
-            active_file = self.files[fh] 
-            if active_file.changed:
-                retval = os.fsync(active_file.cfh)
-                os.close(active_file.cfh)
-                try:
-                    #text = open(active_file.cpath, "r").read()
-                    tmpcpath = active_file.duplicate_cpath()
-                    if tmpcpath is None:
-                        logger.error("tmpcpath is None using cpath" + active_file.cpath)
-                        tmpcpath = active_file.cpath
-                    print "Real Path: " + self.get_real_path(active_file.path)
-                    if not self.seap.allow_write_by_path(tmpcpath,
-                                                        self.get_real_path(active_file.path), 
-                                                         context):
-                       logger.info("block flush to " + active_file.path)
-                       if active_file.recovery_file is None:
-                           os.remove(active_file.path)
-                       else:
-                           shutil.copy2(active_file.recovery_file, active_file.path)
-                       retval = -EACCES
-                    else:
-                        shutil.copy2(active_file.cpath, active_file.path)
-                        logger.debug("flush changed file " +
-                                     active_file.to_string())
-                except (IOError, os.error) as why:
-                    errors = str(why) + " " + active_file.to_string() 
-                    logger.error("flush error " + errors)
-                finally:
-                    active_file.cleanup_cpath()
+    def handle_flush_sync_locked(self, active_file, context, durable):
+        if active_file.changed:
+            try:
+                active_file.materialize(self.staging)
+            except (IOError, OSError) as why:
+                logger.error("materialize error " + str(why) + " " +
+                             active_file.to_string())
+                active_file.abort_stream()
+                active_file.release_scratch()
                 active_file.changed = False
-                return retval
+                return -EIO
+            retval = None
+            size = os.fstat(active_file.scratch.fd).st_size
+            try:
+                audited = self.auditor.admit(size)
+                if audited:
+                    try:
+                        self.queue_audit(active_file, size, context)
+                    except:
+                        self.auditor.cancel(size)
+                        raise
+                if not audited and not self.allow_write(active_file, size,
+                                                        context):
+                   logger.info("block flush to " + active_file.path)
+                   self.committer.wait(active_file.path)
+                   if active_file.recovery is not None:
+                       self.restore_original(active_file.path,
+                                             active_file.recovery)
+                   elif active_file.newly_created:
+                       os.remove(active_file.path)
+                   self.invalidate_cache(active_file.path)
+                   retval = -EACCES
+                else:
+                    job = CommitJob(active_file.path, active_file.scratch,
+                                    size)
+                    active_file.scratch = None
+                    if durable or not self.committer.background:
+                        self.committer.wait(job.path)
+                        try:
+                            active_file.unsynced = self.commit_staged(job)
+                            if durable:
+                                self.sync_committed(active_file)
+                        except (IOError, OSError):
+                            if active_file.recovery is not None:
+                                self.restore_original(active_file.path,
+                                                      active_file.recovery)
+                            self.invalidate_cache(active_file.path)
+                            self.keep_failed(job)
+                            raise
+                        finally:
+                            job.release()
+                    else:
+                        if active_file.recovery is not None:
+                            job.recovery = self.recoveries.retain(
+                                                active_file.recovery)
+                        self.committer.submit(job)
+                        active_file.committing = job
+                    logger.debug("flush changed file " +
+                                 active_file.to_string())
+            except (IOError, os.error) as why:
+                errors = str(why) + " " + active_file.to_string() 
+                logger.error("flush error " + errors)
+                retval = -EIO
+            finally:
+                active_file.abort_stream()
+                active_file.release_scratch()
+                self.attributes.invalidate(active_file.path)
+                self.complete_inspection(active_file)
+            active_file.changed = False
+            return retval
+        else:
+            logger.debug("flush unchanged " + active_file.to_string())
+            if durable and active_file.unsynced is not None:
+                self.sync_committed(active_file)
             else:
-                print "Active file unchanged"
-                logger.debug("flush unchanged " + active_file.to_string())
-                return os.fsync(active_file.fh)
+                # repeated flushes of a clean handle, e.g. after dup()
+                self.sync.count("skipped")
+            return None
+
+    def queue_audit(self, active_file, size, context):
+        # callers hold lock, the snapshot stays until the verdict is logged
+        job = AuditJob(active_file, size, context)
+        self.scratch.retain(job.scratch)
+        try:
+            self.auditor.submit(job)
+        except:
+            job.abort_stream()
+            self.scratch.release(job.scratch)
+            raise
+
+    def audit_write(self, job):
+        try:
+            allowed = self.allow_write(job, job.size, job.context)
+        finally:
+            job.abort_stream()
+            self.scratch.release(job.scratch)
+            self.complete_inspection(job)
+        if allowed:
+            logger.debug("audit allow " + job.to_string())
+        else:
+            logger.info("audit block " + self.get_real_path(job.path) + " " +
+                        job.to_string())
+        return allowed
+
+    def complete_inspection(self, active_file):
+        if active_file.inspection is not None:
+            self.scheduler.complete(active_file.inspection)
+            active_file.inspection = None
+
+    def commit_staged(self, job):
+        name = self.scratch.link(job.scratch)
+        try:
+            # the directory is synced with the file, when at all
+            strategy = self.staging.commit(name, job.path, False)
+        except:
+            os.remove(name)
+            raise
+        if strategy == "rename":
+            self.reopen_handles(job.path)
         else:
-            logger.error("flush error EBADF fh:", active_file.fh)  
-            return -EBADF
-        
+            os.remove(name)
+        self.recoveries.invalidate(job.path)
+        self.attributes.invalidate(job.path)
+        return strategy
+
+    def settle_commit(self, active_file):
+        # callers hold lock, waits for the last background commit, -EIO
+        # when it failed and was rolled back, only flush and fsync can still
+        # report that to the application
+        job = active_file.committing
+        if job is None:
+            return None
+        job.done.wait()
+        active_file.committing = None
+        if job.error is not None:
+            return -EIO
+        if job.synced:
+            active_file.unsynced = None
+        elif job.strategy is not None:
+            active_file.unsynced = job.strategy
+        return None
+
+    def rollback_commit(self, job):
+        # a failed commit may have left a truncated or partly copied original
+        if job.recovery is not None:
+            self.restore_original(job.path, job.recovery)
+        self.invalidate_cache(job.path)
+        self.keep_failed(job)
+
+    def keep_failed(self, job):
+        # the application may only learn of the failure from a later flush
+        # or fsync, if at all, so its allowed content is not thrown away
+        directory = os.path.join(TMP_PATH, FAILED_DIR_NAME)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            name = self.scratch.export(job.scratch, directory)
+            logger.error("commit to " + job.path + " failed, content kept " +
+                         "in " + name)
+        except (IOError, OSError) as why:
+            logger.error("commit to " + job.path + " failed, content lost " +
+                         str(why))
+
+    def restore_original(self, path, recovery):
+        if self.recoveries.restore(recovery) == "rename":
+            self.reopen_handles(path)
+        self.attributes.invalidate(path)
+
+    def invalidate_cache(self, path):
+        # the writeback cache still holds the pages of a blocked or failed
+        # write, dropping them may write dirty ones back, so not under lock
+        if not self.writeback:
+            return
+        invalidator = Thread(target=fuse_invalidate_path,
+                             args=(path[len(self.root):],))
+        invalidator.daemon = True
+        invalidator.start()
+
+    def sync_committed(self, active_file):
+        # callers hold lock
+        self.sync_path(active_file.path, active_file.unsynced)
+        active_file.unsynced = None
+
+    def sync_path(self, path, strategy):
+        # the handle may still point at a replaced inode, sync by path
+        try:
+            handle = os.open(path, os.O_RDONLY)
+        except OSError as why:
+            if why.errno != ENOENT:
+                raise
+            return
+        try:
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+        if strategy == "rename":
+            self.staging.sync_directory(path)
+        self.sync.count("synced")
+    
+    def reopen_handles(self, path):
+        # after a rename open handles still point at the replaced inode
+        for active_file in self.files.values():
+            if active_file.path != path:
+                continue
+            flags = active_file.flags & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC)
+            try:
+                handle = os.open(path, flags)
+                try:
+                    os.dup2(handle, active_file.fh)
+                finally:
+                    os.close(handle)
+            except OSError as why:
+                logger.error("reopen error " + str(why) + " " +
+                             active_file.to_string())
+
     def flush(self, path, fh):
         logger.debug("flush "+ self.files[fh].to_string())
-        print "FLUSH is called. Path: " + path
         context = fuse_get_context()
-        return self.handle_flush_sync(fh, context)
+        self.sync.count("flush")
+        active_file = self.files[fh]
+        with active_file.lock:
+            settled = self.settle_commit(active_file)
+            retval = self.handle_flush_sync_locked(active_file, context,
+                                                   self.sync.on_flush)
+        if retval is None:
+            return settled
+        return retval
 
     def fsync(self, path, datasync, fh):
         logger.debug("fsync "+ self.files[fh].to_string())
-        print "fsync: "+ self.files[fh].to_string()
         context = fuse_get_context()
-        return self.handle_flush_sync(fh, context)
+        self.sync.count("fsync")
+        active_file = self.files[fh]
+        with active_file.lock:
+            settled = self.settle_commit(active_file)
+            if not active_file.changed and active_file.unsynced is None:
+                # nothing staged or committed through this handle
+                retval = os.fsync(fh)
+            else:
+                retval = self.handle_flush_sync_locked(active_file, context,
+                                                       True)
+        if retval is None:
+            return settled
+        return retval
 
     def getattr(self, path, fh=None):
-        st = os.lstat(path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-            'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        active_file = self.files.get(fh)
+        if self.committer.pending and (active_file is None or
+                                       not active_file.changed):
+            # allowed content not yet on the device
+            attrs = self.committer.getattr(path)
+            if attrs is not None:
+                return attrs
+        if active_file is not None:
+            # open files are stated by handle, staged changes included
+            with active_file.lock:
+                return active_file.getattr()
+        found, attrs = self.attributes.get(path)
+        if found:
+            if attrs is None:
+                raise FuseOSError(ENOENT)
+            return attrs
+        token = self.attributes.token()
+        try:
+            st = os.lstat(path)
+        except OSError as why:
+            if why.errno == ENOENT:
+                self.attributes.put(path, None, token)
+            raise
+        attrs = stat_attributes(st)
+        self.attributes.put(path, attrs, token)
+        return attrs
 
     getxattr = None
 
     def link(self, target, source):
-        return os.link(source, target)
+        self.committer.wait(source)
+        os.link(source, target)
+        self.attributes.invalidate(target)
+        self.attributes.invalidate(source)
 
     listxattr = None
-    mkdir = os.mkdir
-    mknod = os.mknod
+
+    def mkdir(self, path, mode):
+        os.mkdir(path, mode)
+        self.attributes.invalidate(path)
+
+    def mknod(self, path, mode, dev):
+        os.mknod(path, mode, dev)
+        self.attributes.invalidate(path)
 
     def open(self, path, flags):
-        print "OPEN is called with path: " + path
         context = fuse_get_context()
-        fh = os.open(path, flags)
+        # writes are staged, only truncation touches the original early
+        recovery = None
+        if self.writeback:
+            # the kernel reads pages of write only files for partial writes
+            # and keeps track of the append position itself
+            if flags & O_ACCMODE == os.O_WRONLY:
+                flags = flags & ~O_ACCMODE | os.O_RDWR
+            flags &= ~os.O_APPEND
+        if flags & os.O_TRUNC:
+            self.committer.wait(path)
+        if (flags & os.O_TRUNC and flags & (os.O_WRONLY | os.O_RDWR) and
+                os.path.exists(path)):
+            recovery = self.recoveries.acquire(path)
+        try:
+            fh = os.open(path, flags)
+        except:
+            if recovery is not None:
+                self.recoveries.release(recovery)
+            raise
+        if flags & (os.O_TRUNC | os.O_CREAT):
+            self.attributes.invalidate(path)
         if not fh in self.files:
-            print "OPEN is called fh is not in dictionary"
             active_file = ActiveFile(path, context, fh, False)
             active_file.flags = flags
+            active_file.recovery = recovery
+            if recovery is not None:
+                active_file.unsynced = "truncate"
             logger.debug("open new file " + active_file.to_string())
             self.files.update({fh: active_file})
         return fh
@@ -291,29 +3217,108 @@ class MyDLPFilter(LoggingMixIn, Operations):
     #todo need to add sth here for apps read files 
     #after writing before flushing
     def read(self, path, size, offset, fh):
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.read(fh, size)
+        active_file = self.files[fh]
+        if active_file.changed:
+            with active_file.lock:
+                if active_file.changed:
+                    with active_file.read_lock:
+                        return active_file.read_overlay(size, offset)
+        data = self.committer.read(path, size, offset)
+        if data is not None:
+            return data
+        with active_file.read_lock:
+            return pread(fh, size, offset)
 
-    def readdir(self, path, fh):
-        uid, guid, pid  = fuse_get_context()
-        return ['.', '..'] + os.listdir(path)
+    def read_buf(self, path, size, offset, fh):
+        # unchanged handles are read by fuse itself, straight from the
+        # safe mount, staged ones go through the overlay
+        if self.files[fh].changed or path in self.committer.pending:
+            return None
+        return fh
+
+    def readinto(self, path, buf, offset, fh):
+        active_file = self.files[fh]
+        if active_file.changed or path in self.committer.pending:
+            data = self.read(path, len(buf), offset, fh)
+            buf[:len(data)] = data
+            return len(data)
+        with active_file.read_lock:
+            return active_file.readinto(buf, offset)
+
+    def listing(self, path):
+        # fuse asks for the root as "/"
+        if path.rstrip("/") == self.root:
+            return DirectoryListing(path, (STAGING_DIR_NAME,))
+        return DirectoryListing(path)
+
+    def opendir(self, path):
+        listing = self.listing(path)
+        # open the directory now, so errors are reported by opendir
+        listing.restart()
+        fh = next(self.directory_handles)
+        self.directories[fh] = listing
+        return fh
+
+    def readdir(self, path, fh, offset=0):
+        listing = self.directories.get(fh)
+        if listing is None:
+            listing = self.listing(path)
+        return listing.entries(offset)
+
+    def releasedir(self, path, fh):
+        listing = self.directories.pop(fh, None)
+        if listing is not None:
+            listing.close()
 
     readlink = os.readlink
 
     def release(self, path, fh):
-        print "RELEASE IS CALLED. Path: " + path
-        del self.files[fh]
-        return os.close(fh)
+        logger.debug("release " + path)
+        active_file = self.files.pop(fh)
+        self.sync.count("release")
+        # the kernel ignores what release returns, failed commits are logged
+        # and their content kept by rollback_commit
+        with active_file.lock:
+            if active_file.committing is not None:
+                # a background commit syncs after writing, unless done
+                if self.sync.on_release:
+                    self.committer.make_durable(active_file.committing)
+                self.settle_commit(active_file)
+            if active_file.changed or active_file.unsynced is not None:
+                # the kernel may write cached pages back after the last
+                # flush, and commits of non durable flushes are synced here
+                try:
+                    self.handle_flush_sync_locked(active_file,
+                                                  active_file.context,
+                                                  self.sync.on_release)
+                    self.settle_commit(active_file)
+                except (IOError, OSError) as why:
+                    logger.error("release sync error " + str(why) + " " +
+                                 active_file.to_string())
+        active_file.abort_stream()
+        active_file.release_scratch()
+        if active_file.recovery is not None:
+            self.recoveries.release(active_file.recovery)
+        os.close(fh)
 
     def rename(self, old, new):
         if not new.startswith(self.root):
             new = self.root + new
+        if self.staging.is_staging(new):
+            raise FuseOSError(EACCES)
         logger.debug("rename: " + old + " " + new)  
         uid, guid, pid  = fuse_get_context()
-        return os.rename(old, new)
+        self.committer.wait(old)
+        self.committer.wait_prefix(old + "/")
+        self.committer.cancel(new)
+        os.rename(old, new)
+        self.attributes.invalidate(old, True)
+        self.attributes.invalidate(new, True)
 
-    rmdir = os.rmdir
+    def rmdir(self, path):
+        self.committer.wait_prefix(path + "/")
+        os.rmdir(path)
+        self.attributes.invalidate(path, True)
 
     def statfs(self, path):
         stv = os.statvfs(path)
@@ -322,48 +3327,164 @@ class MyDLPFilter(LoggingMixIn, Operations):
              'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
 
     def symlink(self, target, source):
-        return os.symlink(source, target)
+        os.symlink(source, target)
+        self.attributes.invalidate(target)
 
     def truncate(self, path, length, fh=None):
-        with open(path, 'r+') as f:
-            f.truncate(length)
+        active_file = self.files.get(fh)
+        if active_file is not None:
+            # truncation of an open file is staged like its writes
+            context = fuse_get_context()
+            with active_file.lock:
+                if not active_file.changed:
+                    self.start_overlay(active_file, path, None, context)
+                active_file.abort_stream()
+                return active_file.truncate_overlay(length)
+        self.committer.wait(path)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, length)
+        finally:
+            os.close(fd)
+        self.attributes.invalidate(path)
 
-    unlink = os.unlink
-    utimens = os.utime
+    def unlink(self, path):
+        self.committer.cancel(path)
+        os.unlink(path)
+        self.attributes.invalidate(path)
+
+    def utimens(self, path, times=None):
+        self.committer.wait(path)
+        os.utime(path, times)
+        self.attributes.invalidate(path)
 
     def write(self, path, data, offset, fh):
         context = fuse_get_context()
         if fh in self.files:
             active_file = self.files[fh]
-            if active_file.changed == False:
-                active_file.changed = True 
-                active_file.create_cpath()
-                if not os.path.exists(os.path.dirname(active_file.cpath)):
-                    os.makedirs(os.path.dirname(active_file.cpath))
-                try:
-                    shutil.copy2(path, active_file.cpath)
-                    logger.debug("write copy on change from " + path + " to "
-                                 + active_file.to_string())
-                    
-                except (IOError, os.error) as why:
-                    logger.error("write exception " + str(why))
-                if active_file.mode !=0:
-                    active_file.cfh = os.open(active_file.cpath,
-                                              active_file.flags, 
-                                              active_file.mode)
-                else:
-                    active_file.cfh = os.open(active_file.cpath, 
-                                              active_file.flags)
-            with self.rwlock:
-                logger.debug("write to cpath " + active_file.to_string())
-                os.lseek(active_file.cfh, offset, 0)
-                return os.write(active_file.cfh, data)
+            with active_file.lock:
+                return self.write_locked(active_file, path, data, offset,
+                                         context)
         else:
             logger.error("write error EBADF fh:" + fh)
             return -EBADF 
 
+    def start_overlay(self, active_file, path, offset, context):
+        # the overlay reads the original, which must be the committed one
+        self.committer.wait(path)
+        active_file.reset_digest()
+        if self.seap.streaming and offset == 0:
+            active_file.stream = self.seap.open_stream(
+                                    self.get_real_path(path), context)
+        try:
+            active_file.create_overlay(self.scratch, self.write_buffers)
+        except:
+            active_file.abort_stream()
+            raise
+        active_file.changed = True
+        logger.debug("write overlay on change of " + path + " in "
+                     + active_file.to_string())
+
+    def write_locked(self, active_file, path, data, offset, context):
+        if active_file.changed == False:
+            self.start_overlay(active_file, path, offset, context)
+        logger.debug("write to scratch " + active_file.to_string())
+        written = active_file.write_overlay(data, offset)
+        active_file.update_digest(data[:written], offset)
+        active_file.update_stream(data[:written], offset)
+        return written
 
-def start_fuse(mount_point, safe_point):
+
+def config_name(section, key):
+    prefix = CONFIG_SECTIONS.get(section)
+    if prefix is None:
+        return None
+    name = prefix + key.upper()
+    if not prefix and not name in FILTERFS_SETTINGS:
+        return None
+    if not name in globals():
+        return None
+    return name
+
+
+def set_option(section, key, value):
+    name = config_name(section, key)
+    if name is None:
+        raise ValueError("unknown option " + section + "." + key)
+    default = globals()[name]
+    if isinstance(default, bool):
+        if not value.lower() in ("1", "yes", "true", "on", "0", "no",
+                                 "false", "off"):
+            raise ValueError("not a boolean " + section + "." + key)
+        value = value.lower() in ("1", "yes", "true", "on")
+    elif isinstance(default, int):
+        value = int(value, 0)
+    elif isinstance(default, float):
+        value = float(value)
+    globals()[name] = value
+
+
+def load_config(path):
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(path):
+        return False
+    for section in parser.sections():
+        for key, value in parser.items(section):
+            set_option(section, key, value)
+    return True
+
+
+def parse_options(options):
+    # mount style -o list, bare keys are fuse options, "nokey" turns one off
+    for option in options.split(","):
+        if not option:
+            continue
+        key, sep, value = option.partition("=")
+        section, dot, name = key.rpartition(".")
+        if not dot:
+            section = "fuse"
+        if not sep:
+            value = "true"
+            if name.startswith("no") and config_name(section, name) is None:
+                name, value = name[2:], "false"
+        set_option(section, name, value)
+
+
+def writeback_cache():
+    if not FUSE_WRITEBACK_CACHE or fuse_version() < 300:
+        return False
+    if not fuse_can_invalidate():
+        logger.warning("writeback cache disabled, libfuse cannot invalidate "
+                       "the pages of blocked writes")
+        return False
+    return True
+
+
+def fuse_options():
+    options = {"attr_timeout": FUSE_ATTR_TIMEOUT,
+               "entry_timeout": FUSE_ENTRY_TIMEOUT,
+               "negative_timeout": FUSE_NEGATIVE_TIMEOUT,
+               "max_write": FUSE_MAX_WRITE, "max_read": FUSE_MAX_READ,
+               "max_readahead": FUSE_MAX_READAHEAD}
+    if FUSE_BIG_WRITES:
+        options["big_writes"] = True
+    if not FUSE_MULTITHREADED:
+        options["nothreads"] = True
+    if fuse_version() >= 29:
+        options["max_background"] = FUSE_MAX_BACKGROUND
+        options["congestion_threshold"] = FUSE_CONGESTION_THRESHOLD
+        if FUSE_SPLICE_READS:
+            options["splice_write"] = True
+    if fuse_version() >= 300:
+        options["writeback_cache"] = writeback_cache()
+        options["readdirplus"] = FUSE_READDIRPLUS
+        if FUSE_MULTITHREADED and FUSE_CLONE_FD:
+            options["clone_fd"] = True
+    return options
+
+
+def start_fuse(mount_point, safe_point, attr_timeout=None, entry_timeout=None,
+               negative_timeout=None):
     try:
         if not os.path.exists(safe_point):
             os.makedirs(safe_point)
@@ -383,8 +3504,16 @@ def start_fuse(mount_point, safe_point):
         logger.debug("mount bind execution failed: " + e.strerror)
         print "mount bind execution failed: " + e.strerror
     
+    options = fuse_options()
+    for key, value in (("attr_timeout", attr_timeout),
+                       ("entry_timeout", entry_timeout),
+                       ("negative_timeout", negative_timeout)):
+        if value is not None:
+            options[key] = value
+    logger.info("FUSE options " + str(options))
     fuse = FUSE(MyDLPFilter(mount_point, safe_point), mount_point, foreground=True, 
-                nonempty=True, allow_other=True)
+                nonempty=True, allow_other=True, zero_copy=FUSE_ZERO_COPY,
+                **options)
 
 def remove_old_safe_mount(path):
     if os.path.isdir(path):
@@ -442,12 +3571,28 @@ if __name__ == '__main__':
     logger.addHandler(handler)
     logger.setLevel(logging.DEBUG)
     
-    if len(argv) != 2:
-        print('usage: %s  <mountpoint>' % argv[0])
-        logger.error("Incorrect parameters")
+    parser = ArgumentParser(description="MyDLP filter file system")
+    parser.add_argument("mountpoint")
+    parser.add_argument("-c", "--config", default=CONFIG_FILE,
+                        help="configuration file (default %(default)s)")
+    parser.add_argument("-o", dest="options", action="append", default=[],
+                        help="override settings, [section.]key[=value],...")
+    parser.add_argument("-s", dest="single", action="store_true",
+                        help="single threaded")
+    opts = parser.parse_args()
+    try:
+        if load_config(opts.config):
+            logger.info("Loaded " + opts.config)
+        for options in opts.options:
+            parse_options(options)
+    except (ConfigParser.Error, ValueError) as why:
+        print "configuration error: " + str(why)
+        logger.error("configuration error " + str(why))
         exit(1)
-    
-    mount_point = argv[1]
+    if opts.single:
+        FUSE_MULTITHREADED = False
+
+    mount_point = opts.mountpoint
     safe_point = SAFE_MNT_PATH + realpath(mount_point)
     
     logger.debug("Starting MyDLP filterfs on " + mount_point)
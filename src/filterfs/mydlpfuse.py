@@ -63,7 +63,8 @@ if _system == 'Darwin':
     _libfuse_path = (find_library('fuse4x') or find_library('osxfuse') or
                      find_library('fuse'))
 else:
-    _libfuse_path = find_library('fuse')
+    # libfuse 3 is preferred when it is installed
+    _libfuse_path = find_library('fuse3') or find_library('fuse')
 
 if not _libfuse_path:
     raise EnvironmentError('Unable to find libfuse')
@@ -73,6 +74,13 @@ else:
 if _system == 'Darwin' and hasattr(_libfuse, 'macfuse_version'):
     _system = 'Darwin-MacFuse'
 
+# 26 to 29 for libfuse 2, 300 and up for libfuse 3
+_libfuse_major = 3 if _libfuse.fuse_version() >= 300 else 2
+
+_libc = CDLL(find_library('c'))
+_libc.malloc.argtypes = [c_size_t]
+_libc.malloc.restype = c_void_p
+
 
 if _system in ('Darwin', 'Darwin-MacFuse', 'FreeBSD'):
     ENOTSUP = 45
@@ -226,17 +234,65 @@ if _system == 'FreeBSD':
             ('f_flag', c_ulong),
             ('f_frsize', c_ulong)]
 
-class fuse_file_info(Structure):
-    _fields_ = [
-        ('flags', c_int),
-        ('fh_old', c_ulong),
-        ('writepage', c_int),
-        ('direct_io', c_uint, 1),
-        ('keep_cache', c_uint, 1),
-        ('flush', c_uint, 1),
-        ('padding', c_uint, 29),
-        ('fh', c_uint64),
-        ('lock_owner', c_uint64)]
+if _libfuse_major >= 3:
+    # the bits moved around between 3.x releases, flags and fh did not
+    class fuse_file_info(Structure):
+        _fields_ = [
+            ('flags', c_int),
+            ('writepage', c_uint, 1),
+            ('direct_io', c_uint, 1),
+            ('keep_cache', c_uint, 1),
+            ('flush', c_uint, 1),
+            ('nonseekable', c_uint, 1),
+            ('flock_release', c_uint, 1),
+            ('cache_readdir', c_uint, 1),
+            ('noflush', c_uint, 1),
+            ('padding', c_uint, 24),
+            ('padding2', c_uint, 32),
+            ('fh', c_uint64),
+            ('lock_owner', c_uint64),
+            ('poll_events', c_uint32)]
+
+    # only the fields up to time_gran are used, later ones are version
+    # dependent
+    class fuse_conn_info(Structure):
+        _fields_ = [
+            ('proto_major', c_uint),
+            ('proto_minor', c_uint),
+            ('max_write', c_uint),
+            ('max_read', c_uint),
+            ('max_readahead', c_uint),
+            ('capable', c_uint),
+            ('want', c_uint),
+            ('max_background', c_uint),
+            ('congestion_threshold', c_uint),
+            ('time_gran', c_uint),
+            ('reserved', c_uint * 22)]
+else:
+    class fuse_file_info(Structure):
+        _fields_ = [
+            ('flags', c_int),
+            ('fh_old', c_ulong),
+            ('writepage', c_int),
+            ('direct_io', c_uint, 1),
+            ('keep_cache', c_uint, 1),
+            ('flush', c_uint, 1),
+            ('padding', c_uint, 29),
+            ('fh', c_uint64),
+            ('lock_owner', c_uint64)]
+
+    class fuse_conn_info(Structure):
+        _fields_ = [
+            ('proto_major', c_uint),
+            ('proto_minor', c_uint),
+            ('async_read', c_uint),
+            ('max_write', c_uint),
+            ('max_readahead', c_uint),
+            ('capable', c_uint),
+            ('want', c_uint),
+            ('max_background', c_uint),
+            ('congestion_threshold', c_uint),
+            ('reserved', c_uint * 23)]
 
 class fuse_context(Structure):
     _fields_ = [
@@ -248,6 +304,150 @@ class fuse_context(Structure):
 
 _libfuse.fuse_get_context.restype = POINTER(fuse_context)
 
+if _libfuse_major >= 3 and hasattr(_libfuse, 'fuse_invalidate_path'):
+    _libfuse.fuse_invalidate_path.argtypes = (c_voidp, c_char_p)
+    _libfuse.fuse_invalidate_path.restype = c_int
+
+# the struct fuse of the mounted filesystem, known once init ran
+_fuse_handle = None
+
+FUSE_BUF_IS_FD = 1 << 1
+FUSE_BUF_FD_SEEK = 1 << 2
+FUSE_BUF_FD_RETRY = 1 << 3
+
+class fuse_buf(Structure):
+    _fields_ = [
+        ('size', c_size_t),
+        ('flags', c_int),
+        ('mem', c_voidp),
+        ('fd', c_int),
+        ('pos', c_off_t)]
+
+class fuse_bufvec(Structure):
+    _fields_ = [
+        ('count', c_size_t),
+        ('idx', c_size_t),
+        ('off', c_size_t),
+        ('buf', fuse_buf * 1)]
+
+
+FUSE_CAP_ASYNC_READ = 1 << 0
+FUSE_CAP_SPLICE_WRITE = 1 << 7
+FUSE_CAP_SPLICE_MOVE = 1 << 8
+FUSE_CAP_SPLICE_READ = 1 << 9
+FUSE_CAP_READDIRPLUS = 1 << 13
+FUSE_CAP_READDIRPLUS_AUTO = 1 << 14
+FUSE_CAP_WRITEBACK_CACHE = 1 << 16
+
+FUSE_READDIR_PLUS = 1 << 0
+FUSE_FILL_DIR_PLUS = 1 << 1
+
+# libfuse 3 options that are set on fuse_conn_info in init instead of
+# being parsed from the command line
+FUSE3_CONN_FLAGS = {
+    'async_read': FUSE_CAP_ASYNC_READ,
+    'splice_write': FUSE_CAP_SPLICE_WRITE,
+    'splice_move': FUSE_CAP_SPLICE_MOVE,
+    'splice_read': FUSE_CAP_SPLICE_READ,
+    'readdirplus': FUSE_CAP_READDIRPLUS | FUSE_CAP_READDIRPLUS_AUTO,
+    'writeback_cache': FUSE_CAP_WRITEBACK_CACHE}
+FUSE3_CONN_LIMITS = ('max_write', 'max_readahead', 'max_background',
+                     'congestion_threshold')
+# always on in libfuse 3, which rejects them
+FUSE3_REMOVED_OPTIONS = ('big_writes', 'nonempty')
+
+
+class fuse3_operations(Structure):
+    _fields_ = [
+        ('getattr', CFUNCTYPE(c_int, c_char_p, POINTER(c_stat),
+                              POINTER(fuse_file_info))),
+        ('readlink', CFUNCTYPE(c_int, c_char_p, POINTER(c_byte), c_size_t)),
+        ('mknod', CFUNCTYPE(c_int, c_char_p, c_mode_t, c_dev_t)),
+        ('mkdir', CFUNCTYPE(c_int, c_char_p, c_mode_t)),
+        ('unlink', CFUNCTYPE(c_int, c_char_p)),
+        ('rmdir', CFUNCTYPE(c_int, c_char_p)),
+        ('symlink', CFUNCTYPE(c_int, c_char_p, c_char_p)),
+        ('rename', CFUNCTYPE(c_int, c_char_p, c_char_p, c_uint)),
+        ('link', CFUNCTYPE(c_int, c_char_p, c_char_p)),
+        ('chmod', CFUNCTYPE(c_int, c_char_p, c_mode_t,
+                            POINTER(fuse_file_info))),
+        ('chown', CFUNCTYPE(c_int, c_char_p, c_uid_t, c_gid_t,
+                            POINTER(fuse_file_info))),
+        ('truncate', CFUNCTYPE(c_int, c_char_p, c_off_t,
+                               POINTER(fuse_file_info))),
+        ('open', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info))),
+
+        ('read', CFUNCTYPE(c_int, c_char_p, POINTER(c_byte), c_size_t,
+                           c_off_t, POINTER(fuse_file_info))),
+
+        ('write', CFUNCTYPE(c_int, c_char_p, POINTER(c_byte), c_size_t,
+                            c_off_t, POINTER(fuse_file_info))),
+
+        ('statfs', CFUNCTYPE(c_int, c_char_p, POINTER(c_statvfs))),
+        ('flush', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info))),
+        ('release', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info))),
+        ('fsync', CFUNCTYPE(c_int, c_char_p, c_int, POINTER(fuse_file_info))),
+        ('setxattr', setxattr_t),
+        ('getxattr', getxattr_t),
+        ('listxattr', CFUNCTYPE(c_int, c_char_p, POINTER(c_byte), c_size_t)),
+        ('removexattr', CFUNCTYPE(c_int, c_char_p, c_char_p)),
+        ('opendir', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info))),
+
+        ('readdir', CFUNCTYPE(c_int, c_char_p, c_voidp,
+                              CFUNCTYPE(c_int, c_voidp, c_char_p,
+                                        POINTER(c_stat), c_off_t, c_int),
+                              c_off_t, POINTER(fuse_file_info), c_int)),
+
+        ('releasedir', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info))),
+
+        ('fsyncdir', CFUNCTYPE(c_int, c_char_p, c_int,
+                               POINTER(fuse_file_info))),
+
+        ('init', CFUNCTYPE(c_voidp, POINTER(fuse_conn_info), c_voidp)),
+        ('destroy', CFUNCTYPE(c_voidp, c_voidp)),
+        ('access', CFUNCTYPE(c_int, c_char_p, c_int)),
+
+        ('create', CFUNCTYPE(c_int, c_char_p, c_mode_t,
+                             POINTER(fuse_file_info))),
+
+        ('lock', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info),
+                           c_int, c_voidp)),
+
+        ('utimens', CFUNCTYPE(c_int, c_char_p, POINTER(c_utimbuf),
+                              POINTER(fuse_file_info))),
+
+        ('bmap', CFUNCTYPE(c_int, c_char_p, c_size_t, POINTER(c_ulonglong))),
+
+        ('ioctl', CFUNCTYPE(c_int, c_char_p, c_uint, c_voidp,
+                            POINTER(fuse_file_info), c_uint, c_voidp)),
+
+        ('poll', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info),
+                           c_voidp, POINTER(c_uint))),
+
+        ('write_buf', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_bufvec),
+                                c_off_t, POINTER(fuse_file_info))),
+
+        ('read_buf', CFUNCTYPE(c_int, c_char_p,
+                               POINTER(POINTER(fuse_bufvec)), c_size_t,
+                               c_off_t, POINTER(fuse_file_info))),
+
+        ('flock', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info),
+                            c_int)),
+
+        ('fallocate', CFUNCTYPE(c_int, c_char_p, c_int, c_off_t, c_off_t,
+                                POINTER(fuse_file_info))),
+
+        # FUSE 3.4
+        ('copy_file_range', CFUNCTYPE(c_ssize_t, c_char_p,
+                                      POINTER(fuse_file_info), c_off_t,
+                                      c_char_p, POINTER(fuse_file_info),
+                                      c_off_t, c_size_t, c_int)),
+
+        # FUSE 3.8
+        ('lseek', CFUNCTYPE(c_off_t, c_char_p, c_off_t, c_int,
+                            POINTER(fuse_file_info))),
+    ]
+
 
 class fuse_operations(Structure):
     _fields_ = [
@@ -311,9 +511,39 @@ class fuse_operations(Structure):
 
         ('utimens', CFUNCTYPE(c_int, c_char_p, POINTER(c_utimbuf))),
         ('bmap', CFUNCTYPE(c_int, c_char_p, c_size_t, POINTER(c_ulonglong))),
+
+        # FUSE 2.8
+        ('flag_nullpath_ok', c_uint, 1),
+        ('flag_nopath', c_uint, 1),
+        ('flag_utime_omit_ok', c_uint, 1),
+        ('flag_reserved', c_uint, 29),
+
+        ('ioctl', CFUNCTYPE(c_int, c_char_p, c_int, c_voidp,
+                            POINTER(fuse_file_info), c_uint, c_voidp)),
+
+        ('poll', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info),
+                           c_voidp, POINTER(c_uint))),
+
+        # FUSE 2.9
+        ('write_buf', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_bufvec),
+                                c_off_t, POINTER(fuse_file_info))),
+
+        ('read_buf', CFUNCTYPE(c_int, c_char_p,
+                               POINTER(POINTER(fuse_bufvec)), c_size_t,
+                               c_off_t, POINTER(fuse_file_info))),
+
+        ('flock', CFUNCTYPE(c_int, c_char_p, POINTER(fuse_file_info),
+                            c_int)),
+
+        ('fallocate', CFUNCTYPE(c_int, c_char_p, c_int, c_off_t, c_off_t,
+                                POINTER(fuse_file_info))),
     ]
 
 
+if _libfuse_major >= 3:
+    fuse_operations = fuse3_operations
+
+
 def time_of_timespec(ts):
     return ts.tv_sec + ts.tv_nsec / 10 ** 9
 
@@ -327,6 +557,11 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+def fuse_version():
+    """Returns the libfuse API version, e.g. 29 for 2.9 and 316 for 3.16"""
+    return _libfuse.fuse_version()
+
+
 def fuse_get_context():
     """Returns a (uid, gid, pid) tuple"""
     ctxp = _libfuse.fuse_get_context()
@@ -334,6 +569,60 @@ def fuse_get_context():
     return ctx.uid, ctx.gid, ctx.pid
 
 
+def fuse_can_invalidate():
+    """Returns True when fuse_invalidate_path can drop cached pages"""
+    return _libfuse_major >= 3 and hasattr(_libfuse, 'fuse_invalidate_path')
+
+
+def fuse_invalidate_path(path, encoding='utf-8'):
+    """Drops the kernel's cached pages and attributes of path, returns
+       False when that is not possible, e.g. before init or with libfuse 2.
+
+       Must not be called with locks held that a write of the same file
+       needs, the kernel may write dirty pages back first."""
+    if _fuse_handle is None or not fuse_can_invalidate():
+        return False
+    if not isinstance(path, bytes):
+        path = path.encode(encoding)
+    return _libfuse.fuse_invalidate_path(_fuse_handle, path) == 0
+
+
+def buffer_view(buf, size, readonly):
+    """memoryview over size bytes of a fuse buffer. It is only valid until
+       the operation returns."""
+    array = (c_char * size).from_address(addressof(buf.contents))
+    if not readonly:
+        return memoryview(array)
+    try:
+        return memoryview(buffer(array))
+    except NameError:
+        return memoryview(array).toreadonly()
+
+
+_ascii = ''.join(map(chr, range(128)))
+
+def path_decoder(encoding):
+    def decode(path):
+        # pure ascii strings need no decoding
+        if not path.translate(None, _ascii):
+            return path
+        return path.decode(encoding)
+    return decode
+
+
+class OperationTable(dict):
+    """Maps operation names to the callables returned by
+       Operations.resolve, each resolved once."""
+
+    def __init__(self, operations):
+        dict.__init__(self)
+        self.operations = operations
+
+    def __missing__(self, op):
+        method = self[op] = self.operations.resolve(op)
+        return method
+
+
 class FuseOSError(OSError):
     def __init__(self, errno):
         super(FuseOSError, self).__init__(errno, strerror(errno))
@@ -345,15 +634,19 @@ class FUSE(object):
        Assumes API version 2.6 or later."""
 
     def __init__(self, operations, mountpoint, raw_fi=False, encoding='utf-8',
-                 **kwargs):
+                 zero_copy=False, **kwargs):
 
         """Setting raw_fi to True will cause FUSE to pass the fuse_file_info
            class as is to Operations, instead of just the fh field.
-           This gives you access to direct_io, keep_cache, etc."""
+           This gives you access to direct_io, keep_cache, etc.
+
+           Setting zero_copy to True will cause reads to be served by
+           readinto with a writable memoryview over the fuse buffer and
+           writes to get a read-only memoryview instead of a string."""
 
-        self.operations = operations
         self.raw_fi = raw_fi
         self.encoding = encoding
+        self.zero_copy = zero_copy
 
         args = ['fuse']
         if kwargs.pop('foreground', False):
@@ -363,6 +656,14 @@ class FUSE(object):
         if kwargs.pop('nothreads', False):
             args.append('-s')
 
+        self.conn_options = {}
+        if _libfuse_major >= 3:
+            for key in kwargs.keys():
+                if key in FUSE3_CONN_FLAGS or key in FUSE3_CONN_LIMITS:
+                    self.conn_options[key] = kwargs.pop(key)
+                elif key in FUSE3_REMOVED_OPTIONS:
+                    del kwargs[key]
+
         kwargs.setdefault('fsname', operations.__class__.__name__)
         args.append('-o')
         args.append(','.join(self._normalize_fuse_options(**kwargs)))
@@ -371,11 +672,7 @@ class FUSE(object):
         args = [arg.encode(encoding) for arg in args]
         argv = (c_char_p * len(args))(*args)
 
-        fuse_ops = fuse_operations()
-        for name, prototype in fuse_operations._fields_:
-            if prototype != c_voidp and getattr(operations, name, None):
-                op = partial(self._wrapper, getattr(self, name))
-                setattr(fuse_ops, name, prototype(op))
+        fuse_ops = self._prepare(operations)
 
         old_handler = signal(SIGINT, SIG_DFL)
 
@@ -383,10 +680,33 @@ class FUSE(object):
                                       sizeof(fuse_ops), None)
         signal(SIGINT, old_handler)
 
+        del self.dispatch
         del self.operations     # Invoke the destructor
         if err:
             raise RuntimeError(err)
 
+    def _prepare(self, operations):
+        """Resolves the operations once and returns the fuse_operations
+           table pointing at them."""
+
+        self.operations = operations
+        self.decode = path_decoder(self.encoding)
+        self.dispatch = OperationTable(operations)
+        for name in ('readinto', 'getattr', 'truncate', 'open'):
+            if getattr(operations, name, None):
+                self.dispatch[name]
+
+        fuse_ops = fuse_operations()
+        for field in fuse_operations._fields_:
+            name, prototype = field[:2]
+            if len(field) > 2 or prototype == c_voidp:
+                continue    # flag bits and deprecated entries
+            if getattr(operations, name, None):
+                self.dispatch[name]
+                op = partial(self._wrapper, getattr(self, name))
+                setattr(fuse_ops, name, prototype(op))
+        return fuse_ops
+
     @staticmethod
     def _normalize_fuse_options(**kargs):
         for key, value in kargs.items():
@@ -406,11 +726,11 @@ class FUSE(object):
             print_exc()
             return -EFAULT
 
-    def getattr(self, path, buf):
-        return self.fgetattr(path, buf, None)
+    def getattr(self, path, buf, fip=None):
+        return self.fgetattr(path, buf, fip)
 
     def readlink(self, path, buf, bufsize):
-        ret = self.operations('readlink', path.decode(self.encoding)) \
+        ret = self.dispatch['readlink'](self.decode(path)) \
                   .encode(self.encoding)
 
         # copies a string into the given buffer
@@ -420,51 +740,57 @@ class FUSE(object):
         return 0
 
     def mknod(self, path, mode, dev):
-        return self.operations('mknod', path.decode(self.encoding), mode, dev)
+        return self.dispatch['mknod'](self.decode(path), mode, dev)
 
     def mkdir(self, path, mode):
-        return self.operations('mkdir', path.decode(self.encoding), mode)
+        return self.dispatch['mkdir'](self.decode(path), mode)
 
     def unlink(self, path):
-        return self.operations('unlink', path.decode(self.encoding))
+        return self.dispatch['unlink'](self.decode(path))
 
     def rmdir(self, path):
-        return self.operations('rmdir', path.decode(self.encoding))
+        return self.dispatch['rmdir'](self.decode(path))
 
     def symlink(self, source, target):
-        return self.operations('symlink', target.decode(self.encoding),
-                                          source.decode(self.encoding))
+        return self.dispatch['symlink'](self.decode(target),
+                                        self.decode(source))
 
-    def rename(self, old, new):
-        return self.operations('rename', old.decode(self.encoding),
-                                         new.decode(self.encoding))
+    def rename(self, old, new, flags=0):
+        if flags:
+            return -EINVAL  # RENAME_EXCHANGE and RENAME_NOREPLACE
+
+        return self.dispatch['rename'](self.decode(old),
+                                       self.decode(new))
 
     def link(self, source, target):
-        return self.operations('link', target.decode(self.encoding),
-                                       source.decode(self.encoding))
+        return self.dispatch['link'](self.decode(target),
+                                     self.decode(source))
 
-    def chmod(self, path, mode):
-        return self.operations('chmod', path.decode(self.encoding), mode)
+    def chmod(self, path, mode, fip=None):
+        return self.dispatch['chmod'](self.decode(path), mode)
 
-    def chown(self, path, uid, gid):
+    def chown(self, path, uid, gid, fip=None):
         # Check if any of the arguments is a -1 that has overflowed
         if c_uid_t(uid + 1).value == 0:
             uid = -1
         if c_gid_t(gid + 1).value == 0:
             gid = -1
 
-        return self.operations('chown', path.decode(self.encoding), uid, gid)
+        return self.dispatch['chown'](self.decode(path), uid, gid)
+
+    def truncate(self, path, length, fip=None):
+        if fip:
+            return self.ftruncate(path, length, fip)
 
-    def truncate(self, path, length):
-        return self.operations('truncate', path.decode(self.encoding), length)
+        return self.dispatch['truncate'](self.decode(path), length)
 
     def open(self, path, fip):
         fi = fip.contents
         if self.raw_fi:
-            return self.operations('open', path.decode(self.encoding), fi)
+            return self.dispatch['open'](self.decode(path), fi)
         else:
-            fi.fh = self.operations('open', path.decode(self.encoding),
-                                            fi.flags)
+            fi.fh = self.dispatch['open'](self.decode(path),
+                                          fi.flags)
 
             return 0
 
@@ -474,8 +800,13 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        ret = self.operations('read', path.decode(self.encoding), size,
-                                      offset, fh)
+        if self.zero_copy:
+            return self.dispatch['readinto'](self.decode(path),
+                                             buffer_view(buf, size, False),
+                                             offset, fh)
+
+        ret = self.dispatch['read'](self.decode(path), size,
+                                    offset, fh)
 
         if not ret: return 0
 
@@ -483,24 +814,58 @@ class FUSE(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
         memmove(buf, ret, retsize)
         return retsize
 
+    def read_buf(self, path, bufp, size, offset, fip):
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        # fuse frees the vector and the memory it points to with free()
+        vec = cast(_libc.malloc(sizeof(fuse_bufvec)), POINTER(fuse_bufvec))
+        if not vec:
+            return -ENOMEM
+        memset(vec, 0, sizeof(fuse_bufvec))
+        bufp[0] = vec
+        vec.contents.count = 1
+        buf = vec.contents.buf[0]
+
+        fd = self.dispatch['read_buf'](self.decode(path), size,
+                                       offset, fh)
+        if fd is not None:
+            # fuse splices or copies straight from fd, never through python
+            buf.flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK
+            buf.fd = fd
+            buf.pos = offset
+            buf.size = size
+            return 0
+
+        buf.mem = _libc.malloc(max(size, 1))
+        if not buf.mem:
+            return -ENOMEM
+        buf.size = self.read(path, cast(buf.mem, POINTER(c_byte)), size,
+                             offset, fip)
+        return 0
+
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
+        if self.zero_copy:
+            data = buffer_view(buf, size, True)
+        else:
+            data = string_at(buf, size)
 
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
-        return self.operations('write', path.decode(self.encoding), data,
-                                        offset, fh)
+        return self.dispatch['write'](self.decode(path), data,
+                                      offset, fh)
 
     def statfs(self, path, buf):
         stv = buf.contents
-        attrs = self.operations('statfs', path.decode(self.encoding))
+        attrs = self.dispatch['statfs'](self.decode(path))
         for key, val in attrs.items():
             if hasattr(stv, key):
                 setattr(stv, key, val)
@@ -513,7 +878,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('flush', path.decode(self.encoding), fh)
+        return self.dispatch['flush'](self.decode(path), fh)
 
     def release(self, path, fip):
         if self.raw_fi:
@@ -521,7 +886,7 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        return self.operations('release', path.decode(self.encoding), fh)
+        return self.dispatch['release'](self.decode(path), fh)
 
     def fsync(self, path, datasync, fip):
         if self.raw_fi:
@@ -529,17 +894,18 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('fsync', path.decode(self.encoding), datasync,
-                                        fh)
+        return self.dispatch['fsync'](self.decode(path), datasync,
+                                      fh)
 
     def setxattr(self, path, name, value, size, options, *args):
-        return self.operations('setxattr', path.decode(self.encoding),
-                               name.decode(self.encoding),
-                               string_at(value, size), options, *args)
+        return self.dispatch['setxattr'](self.decode(path),
+                                         self.decode(name),
+                                         string_at(value, size), options,
+                                         *args)
 
     def getxattr(self, path, name, value, size, *args):
-        ret = self.operations('getxattr', path.decode(self.encoding),
-                                          name.decode(self.encoding), *args)
+        ret = self.dispatch['getxattr'](self.decode(path),
+                                        self.decode(name), *args)
 
         retsize = len(ret)
         # allow size queries
@@ -554,7 +920,7 @@ class FUSE(object):
         return retsize
 
     def listxattr(self, path, namebuf, size):
-        attrs = self.operations('listxattr', path.decode(self.encoding)) or ''
+        attrs = self.dispatch['listxattr'](self.decode(path)) or ''
         ret = '\x00'.join(attrs).encode(self.encoding) + '\x00'
 
         retsize = len(ret)
@@ -570,20 +936,25 @@ class FUSE(object):
         return retsize
 
     def removexattr(self, path, name):
-        return self.operations('removexattr', path.decode(self.encoding),
-                                              name.decode(self.encoding))
+        return self.dispatch['removexattr'](self.decode(path),
+                                            self.decode(name))
 
     def opendir(self, path, fip):
         # Ignore raw_fi
-        fip.contents.fh = self.operations('opendir',
-                                          path.decode(self.encoding))
+        fip.contents.fh = self.dispatch['opendir'](self.decode(path))
 
         return 0
 
-    def readdir(self, path, buf, filler, offset, fip):
+    def readdir(self, path, buf, filler, offset, fip, flags=0):
+        # with FUSE_FILL_DIR_PLUS libfuse 3 looks each entry up right away,
+        # saving the kernel a lookup request per entry
+        fill_flags = 0
+        if flags & FUSE_READDIR_PLUS:
+            fill_flags = FUSE_FILL_DIR_PLUS
+
         # Ignore raw_fi
-        for item in self.operations('readdir', path.decode(self.encoding),
-                                               fip.contents.fh):
+        for item in self.dispatch['readdir'](self.decode(path),
+                                             fip.contents.fh, offset):
 
             if isinstance(item, basestring):
                 name, st, offset = item, None, 0
@@ -595,38 +966,62 @@ class FUSE(object):
                 else:
                     st = None
 
-            if filler(buf, name.encode(self.encoding), st, offset) != 0:
+            if _libfuse_major >= 3:
+                if fill_flags and not st:
+                    st = c_stat()   # libfuse fills it in with getattr
+                full = filler(buf, name.encode(self.encoding), st, offset,
+                              fill_flags if st else 0)
+            else:
+                full = filler(buf, name.encode(self.encoding), st, offset)
+            if full != 0:
                 break
 
         return 0
 
     def releasedir(self, path, fip):
         # Ignore raw_fi
-        return self.operations('releasedir', path.decode(self.encoding),
-                                             fip.contents.fh)
+        return self.dispatch['releasedir'](self.decode(path),
+                                           fip.contents.fh)
 
     def fsyncdir(self, path, datasync, fip):
         # Ignore raw_fi
-        return self.operations('fsyncdir', path.decode(self.encoding),
-                                           datasync, fip.contents.fh)
-
-    def init(self, conn):
-        return self.operations('init', '/')
+        return self.dispatch['fsyncdir'](self.decode(path),
+                                         datasync, fip.contents.fh)
+
+    def init(self, conn, config=None):
+        global _fuse_handle
+        _fuse_handle = _libfuse.fuse_get_context().contents.fuse
+        if _libfuse_major >= 3 and conn:
+            self._negotiate(conn.contents)
+        return self.dispatch['init']('/')
+
+    def _negotiate(self, conn):
+        for key, value in self.conn_options.items():
+            if key in FUSE3_CONN_FLAGS:
+                flag = FUSE3_CONN_FLAGS[key]
+                if value:
+                    conn.want |= flag & conn.capable
+                else:
+                    conn.want &= ~flag
+            elif key == 'max_readahead':
+                conn.max_readahead = min(value, conn.max_readahead)
+            else:
+                setattr(conn, key, value)
 
     def destroy(self, private_data):
-        return self.operations('destroy', '/')
+        return self.dispatch['destroy']('/')
 
     def access(self, path, amode):
-        return self.operations('access', path.decode(self.encoding), amode)
+        return self.dispatch['access'](self.decode(path), amode)
 
     def create(self, path, mode, fip):
         fi = fip.contents
-        path = path.decode(self.encoding)
+        path = self.decode(path)
 
         if self.raw_fi:
-            return self.operations('create', path, mode, fi)
+            return self.dispatch['create'](path, mode, fi)
         else:
-            fi.fh = self.operations('create', path, mode)
+            fi.fh = self.dispatch['create'](path, mode)
             return 0
 
     def ftruncate(self, path, length, fip):
@@ -635,21 +1030,21 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('truncate', path.decode(self.encoding),
-                                           length, fh)
+        return self.dispatch['truncate'](self.decode(path),
+                                         length, fh)
 
     def fgetattr(self, path, buf, fip):
         memset(buf, 0, sizeof(c_stat))
 
         st = buf.contents
         if not fip:
-            fh = fip
+            fh = None
         elif self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
-        attrs = self.operations('getattr', path.decode(self.encoding), fh)
+        attrs = self.dispatch['getattr'](self.decode(path), fh)
         set_st_attrs(st, attrs)
         return 0
 
@@ -659,10 +1054,10 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('lock', path.decode(self.encoding), fh, cmd,
-                                       lock)
+        return self.dispatch['lock'](self.decode(path), fh, cmd,
+                                     lock)
 
-    def utimens(self, path, buf):
+    def utimens(self, path, buf, fip=None):
         if buf:
             atime = time_of_timespec(buf.contents.actime)
             mtime = time_of_timespec(buf.contents.modtime)
@@ -670,11 +1065,11 @@ class FUSE(object):
         else:
             times = None
 
-        return self.operations('utimens', path.decode(self.encoding), times)
+        return self.dispatch['utimens'](self.decode(path), times)
 
     def bmap(self, path, blocksize, idx):
-        return self.operations('bmap', path.decode(self.encoding), blocksize,
-                                       idx)
+        return self.dispatch['bmap'](self.decode(path), blocksize,
+                                     idx)
 
 
 class Operations(object):
@@ -690,6 +1085,17 @@ class Operations(object):
             raise FuseOSError(EFAULT)
         return getattr(self, op)(*args)
 
+    def resolve(self, op):
+        """Returns the callable FUSE uses for op, it takes the arguments of
+           __call__ after op. Subclasses that override __call__ should
+           override resolve the same way."""
+
+        method = getattr(self, op, None)
+        if not method:
+            def method(*args):
+                raise FuseOSError(EFAULT)
+        return method
+
     def access(self, path, amode):
         return 0
 
@@ -779,9 +1185,22 @@ class Operations(object):
         """Returns a string containing the data requested."""
         raise FuseOSError(EIO)
 
-    def readdir(self, path, fh):
+    read_buf = None
+
+    def readinto(self, path, buf, offset, fh):
+        """Fills the writable memoryview buf and returns the number of bytes
+           read. Only called when FUSE was started with zero_copy=True."""
+        data = self.read(path, len(buf), offset, fh)
+        buf[:len(data)] = data
+        return len(data)
+
+    def readdir(self, path, fh, offset=0):
         """Can return either a list of names, or a list of
-           (name, attrs, offset) tuples. attrs is a dict as in getattr."""
+           (name, attrs, offset) tuples. attrs is a dict as in getattr.
+
+           With non-zero offsets fuse stops when its buffer is full and
+           calls readdir again with the offset of the last entry it took,
+           entries after that offset should be returned then."""
         return ['.', '..']
 
     def readlink(self, path):
@@ -830,17 +1249,30 @@ class Operations(object):
         raise FuseOSError(EROFS)
 
 
-class LoggingMixIn:
+class LoggingMixIn(object):
 
-    def __call__(self, op, path, *args):
-        #print '->', op, path, repr(args)
+    log = logging.getLogger('fuse.log-mixin')
+
+    # when False operations are resolved without the logging wrapper
+    log_operations = True
+
+    def resolve(self, op):
+        method = super(LoggingMixIn, self).resolve(op)
+        if not self.log_operations:
+            return method
+        return partial(self._logged, op, method)
+
+    def _logged(self, op, method, path, *args):
+        self.log.debug('-> %s %s %s', op, path, repr(args))
         ret = '[Unhandled Exception]'
         try:
-            ret = getattr(self, op)(path, *args)
+            ret = method(path, *args)
             return ret
         except OSError, e:
             ret = str(e)
             raise
         finally:
-            pass
-            #print '<-', op, repr(ret)
+            self.log.debug('<- %s %s', op, repr(ret))
+
+    def __call__(self, op, path, *args):
+        return self._logged(op, getattr(self, op), path, *args)
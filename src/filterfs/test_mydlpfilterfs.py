@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# Copyright (c) 2012 Ozgur Batur
+# License GPLv3, see http://www.gnu.org/licenses/gpl.html#content
+
+# Unit tests of the filterfs building blocks that need no mount, run with:
+# python -m unittest test_mydlpfilterfs
+
+from __future__ import with_statement
+
+import SocketServer
+import logging
+import time
+import unittest
+
+from StringIO import StringIO
+from threading import Event, Thread
+
+import mydlpfilterfs
+
+from mydlpfilterfs import BackgroundCommitter, CircuitBreaker, \
+        ClassifierRule, CommitJob, ExtentSet, InspectionScheduler, \
+        SeapClient, SeapConnectionPool, load_rules
+
+mydlpfilterfs.logger.addHandler(logging.NullHandler())
+
+
+class SeapHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split()
+            self.server.received.append(line.strip())
+            if command[0] == "QUIT":
+                return
+            if command[0] == "BEGIN":
+                self.server.opids += 1
+                self.wfile.write("OK " + str(self.server.opids) + "\r\n")
+            else:
+                self.wfile.write("OK\r\n")
+
+
+class SeapServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), SeapHandler)
+        self.connections = 0
+        self.opids = 0
+        self.received = []
+
+
+class SeapConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SeapServer()
+        self.port = self.server.server_address[1]
+        server = Thread(target=self.server.serve_forever, args=(0.05,))
+        server.daemon = True
+        server.start()
+        self.pool = SeapConnectionPool("127.0.0.1", self.port, 2, 60)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_checkin_returns_connection_for_reuse(self):
+        conn = self.pool.checkout()
+        self.assertEqual(conn.send("BEGIN"), "OK 1")
+        self.pool.checkin(conn)
+        self.assertTrue(self.pool.checkout() is conn)
+        self.assertEqual(self.pool.opened, 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_checkout_waits_for_a_free_connection(self):
+        first = self.pool.checkout()
+        self.pool.checkout()
+        taken = []
+        waiter = Thread(target=lambda: taken.append(self.pool.checkout()))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(taken, [])
+        self.pool.checkin(first)
+        waiter.join(5)
+        self.assertEqual(taken, [first])
+        self.assertEqual(self.pool.opened, 2)
+
+    def test_broken_connection_is_closed(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn, True)
+        self.assertEqual(self.pool.opened, 0)
+        self.assertEqual(self.pool.idle, [])
+        self.assertFalse(self.pool.checkout() is conn)
+
+    def test_idle_connections_are_evicted(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        conn.last_used -= 61
+        self.assertFalse(self.pool.checkout() is conn)
+        self.assertEqual(self.pool.opened, 1)
+        self.wait_for(lambda: self.server.connections == 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_closed_connection_is_not_reused(self):
+        conn = self.pool.checkout()
+        conn.post("QUIT")
+        self.pool.checkin(conn)
+        time.sleep(0.1)
+        other = self.pool.checkout()
+        self.assertFalse(other is conn)
+        self.assertEqual(other.send("BEGIN"), "OK 1")
+        self.assertEqual(self.pool.opened, 1)
+
+    def test_posted_destroy_is_collected_on_reuse(self):
+        conn = self.pool.checkout()
+        self.assertEqual(conn.send("BEGIN"), "OK 1")
+        conn.post("DESTROY 1")
+        self.pool.checkin(conn)
+        # the DESTROY response must not be taken for the next BEGIN
+        reused = self.pool.checkout()
+        self.assertTrue(reused is conn)
+        self.assertEqual(reused.send("BEGIN"), "OK 2")
+        self.assertEqual(reused.pending, 0)
+        self.assertEqual(self.server.received,
+                         ["BEGIN", "DESTROY 1", "BEGIN"])
+
+    def test_junk_on_idle_connection_drops_it(self):
+        conn = self.pool.checkout()
+        conn.sock.sendall("BEGIN\r\n")
+        time.sleep(0.1)
+        self.pool.checkin(conn)
+        self.assertFalse(self.pool.checkout() is conn)
+
+    def test_begin_retries_a_connection_closed_by_the_server(self):
+        client = SeapClient("127.0.0.1", self.port)
+        client.pool = self.pool
+        conn = self.pool.checkout()
+        conn.send("BEGIN")
+        conn.sock.sendall("QUIT\r\n")
+        self.pool.checkin(conn)
+        # the server may close it after the liveness check
+        conn.is_alive = lambda: True
+        conn, response = client.begin()
+        self.assertEqual(response, "OK 2")
+        self.assertEqual(self.pool.opened, 1)
+
+
+class ExtentSetTest(unittest.TestCase):
+
+    def test_add_merges_overlapping_and_adjacent(self):
+        extents = ExtentSet()
+        extents.add(10, 20)
+        extents.add(30, 40)
+        extents.add(20, 25)
+        extents.add(50, 50)
+        self.assertEqual(list(extents), [(10, 25), (30, 40)])
+        extents.add(5, 35)
+        self.assertEqual(list(extents), [(5, 40)])
+        self.assertEqual(extents.total(), 35)
+
+    def test_segments(self):
+        extents = ExtentSet()
+        extents.add(10, 20)
+        extents.add(30, 40)
+        self.assertEqual(list(extents.segments(0, 35)),
+                         [(0, 10, False), (10, 20, True), (20, 30, False),
+                          (30, 35, True)])
+        self.assertEqual(list(extents.segments(15, 18)), [(15, 18, True)])
+        self.assertEqual(list(extents.segments(40, 45)), [(40, 45, False)])
+
+    def test_truncate(self):
+        extents = ExtentSet()
+        extents.add(10, 20)
+        extents.add(30, 40)
+        extents.truncate(15)
+        self.assertEqual(list(extents), [(10, 15)])
+        extents.truncate(10)
+        self.assertEqual(list(extents), [])
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.probes = []
+        self.breaker = CircuitBreaker(3, 3600, self.probe)
+
+    def probe(self):
+        self.probes.append(time.time())
+
+    def test_trips_at_threshold(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.closed())
+        self.assertEqual(self.breaker.stats()["breaker_rejected"], 1)
+
+    def test_success_resets_failures(self):
+        # a success between failures keeps the circuit closed, so success
+        # must only be reported once a verdict arrived
+        for i in range(5):
+            self.breaker.failure()
+            self.breaker.failure()
+            self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_allows_a_single_trial(self):
+        self.breaker.force_open()
+        self.breaker.state = CircuitBreaker.HALF_OPEN
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.closed())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.breaker.state = CircuitBreaker.HALF_OPEN
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertTrue(self.breaker.closed())
+
+
+class InspectionSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = InspectionScheduler(2, 16, 1)
+        self.order = []
+
+    def inspect(self, name):
+        self.order.append(name)
+        return name
+
+    def test_path_is_held_until_complete(self):
+        self.scheduler.start()
+        first = self.scheduler.submit("/a", "u", 1, self.inspect, "first")
+        self.assertEqual(first.wait(), "first")
+        second = self.scheduler.submit("/a", "u", 1, self.inspect, "second")
+        time.sleep(0.1)
+        # the first flush has not committed yet
+        self.assertFalse(second.done.is_set())
+        self.scheduler.complete(first)
+        self.assertEqual(second.wait(), "second")
+        self.scheduler.complete(second)
+        self.assertEqual(self.scheduler.paths, {})
+
+    def test_other_paths_are_not_held(self):
+        self.scheduler.start()
+        first = self.scheduler.submit("/a", "u", 1, self.inspect, "a")
+        first.wait()
+        other = self.scheduler.submit("/b", "u", 1, self.inspect, "b")
+        self.assertEqual(other.wait(), "b")
+        self.scheduler.complete(first)
+        self.scheduler.complete(other)
+
+    def test_round_robin_over_owners_smallest_first(self):
+        # queue everything before the single worker starts
+        scheduler = InspectionScheduler(1, 16, 1)
+        jobs = [scheduler.submit("/a1", "a", 30, self.inspect, "a30"),
+                scheduler.submit("/a2", "a", 10, self.inspect, "a10"),
+                scheduler.submit("/a3", "a", 20, self.inspect, "a20"),
+                scheduler.submit("/b1", "b", 50, self.inspect, "b50")]
+        scheduler.start()
+        for job in jobs:
+            job.wait()
+            scheduler.complete(job)
+        self.assertEqual(self.order, ["a10", "b50", "a20", "a30"])
+
+    def test_errors_are_raised_by_wait(self):
+        def fail():
+            raise IOError("engine went away")
+        self.scheduler.start()
+        job = self.scheduler.submit("/a", "u", 1, fail)
+        self.assertRaises(IOError, job.wait)
+        self.scheduler.complete(job)
+
+    def test_full_queue_rejects(self):
+        scheduler = InspectionScheduler(1, 1, 0.05)
+        scheduler.submit("/a", "u", 1, self.inspect, "a")
+        self.assertRaises(mydlpfilterfs.InspectionRejected, scheduler.submit,
+                          "/b", "u", 1, self.inspect, "b")
+
+
+class BackgroundCommitterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gate = Event()
+        self.committed = []
+        self.rolled_back = []
+        self.committer = BackgroundCommitter(0, 1, 16, self.commit,
+                                             self.sync, self.rollback)
+
+    def commit(self, job):
+        self.gate.wait(5)
+        if job.size < 0:
+            raise OSError(28, "No space left on device")
+        self.committed.append((job.path, job.size))
+        return "rename"
+
+    def sync(self, path, strategy):
+        pass
+
+    def rollback(self, job):
+        self.rolled_back.append(job.path)
+
+    def test_queued_job_is_superseded(self):
+        self.committer.start()
+        busy = CommitJob("/busy", None, 1)
+        self.committer.submit(busy)
+        time.sleep(0.1)
+        old = CommitJob("/a", None, 1)
+        new = CommitJob("/a", None, 2)
+        self.committer.submit(old)
+        self.committer.submit(new)
+        self.assertTrue(old.done.is_set())
+        self.assertEqual(self.committer.stats()["superseded"], 1)
+        self.gate.set()
+        self.committer.drain()
+        self.assertEqual(self.committed, [("/busy", 1), ("/a", 2)])
+
+    def test_started_job_is_not_superseded(self):
+        self.committer.start()
+        first = CommitJob("/a", None, 1)
+        self.committer.submit(first)
+        time.sleep(0.1)
+        second = CommitJob("/a", None, 2)
+        self.committer.submit(second)
+        self.assertFalse(first.done.is_set())
+        self.gate.set()
+        self.committer.drain()
+        self.assertEqual(self.committed, [("/a", 1), ("/a", 2)])
+
+    def test_cancel_discards_queued_jobs(self):
+        self.committer.start()
+        busy = CommitJob("/busy", None, 1)
+        self.committer.submit(busy)
+        time.sleep(0.1)
+        self.committer.submit(CommitJob("/a", None, 1))
+        waiter = Thread(target=self.committer.cancel, args=("/a",))
+        waiter.start()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(self.committer.stats()["cancelled"], 1)
+        self.gate.set()
+        self.committer.drain()
+        self.assertEqual(self.committed, [("/busy", 1)])
+
+    def test_pending_job_orders_waiters(self):
+        self.committer.submit(CommitJob("/a", None, 1))
+        self.assertTrue("/a" in self.committer.pending)
+        self.gate.set()
+        self.committer.start()
+        self.committer.wait("/a")
+        self.assertFalse("/a" in self.committer.pending)
+
+    def test_failure_is_kept_and_rolled_back(self):
+        self.gate.set()
+        self.committer.start()
+        job = CommitJob("/a", None, -1)
+        self.committer.submit(job)
+        job.done.wait(5)
+        self.assertTrue(isinstance(job.error, OSError))
+        self.assertEqual(self.rolled_back, ["/a"])
+        stats = self.committer.stats()
+        self.assertEqual((stats["errors"], stats["committed"]), (1, 0))
+
+
+class ClassifierRuleTest(unittest.TestCase):
+
+    OLE = "d0cf11e0a1b11ae1".decode("hex")
+
+    def head(self, data):
+        return lambda: data
+
+    def test_empty_rule(self):
+        rule = ClassifierRule("empty", max_size=0)
+        self.assertTrue(rule.matches("a.doc", 0, self.head("")))
+        self.assertFalse(rule.matches("a.doc", 1, self.head("x")))
+
+    def test_defaults_only_skip_empty_files(self):
+        rules = load_rules(StringIO(mydlpfilterfs.PRECLASSIFIER_DEFAULTS))
+        self.assertEqual([rule.name for rule in rules], ["empty"])
+        for name, data in [("Thumbs.db", self.OLE + "x" * 100),
+                           ("~$report.docx", "x" * 100),
+                           (".~lock.a.odt#", "lock"),
+                           ("desktop.ini", "secret"),
+                           (".DS_Store", "\0\0\0\1Bud1" + "x" * 100),
+                           ("._a", "\0\5\x16\7" + "x" * 100)]:
+            for rule in rules:
+                self.assertFalse(rule.matches(name, len(data),
+                                              self.head(data)), name)
+
+    def test_name_only_allow_rules_are_refused(self):
+        self.assertRaises(ValueError, ClassifierRule, "lock",
+                          glob=".~lock.*#", max_size=4096)
+        self.assertRaises(ValueError, ClassifierRule, "thumbs",
+                          glob="Thumbs.db", magic="d0cf11e0a1b11ae1")
+        self.assertRaises(ValueError, ClassifierRule, "txt", extension="txt")
+        # inspect rules cannot let anything through
+        ClassifierRule("txt", action="inspect", extension="txt")
+
+    def test_example_rules(self):
+        # the commented out options, without the prose around them
+        examples = "\n".join(line[1:] for line in
+                              mydlpfilterfs.PRECLASSIFIER_DEFAULTS.split("\n")
+                              if line.startswith("#") and line[1:2].strip())
+        rules = dict((rule.name, rule) for rule in
+                     load_rules(StringIO(examples)))
+        self.assertEqual(sorted(rules), ["locks", "thumbs"])
+        locks = rules["locks"]
+        for name in ("~$report.docx", ".~lock.a.odt#", "d/~$a.xlsx"):
+            self.assertTrue(locks.matches(name, 162, self.head("x" * 162)))
+        self.assertFalse(locks.matches("~$report.docx", 4096,
+                                       self.head("x" * 4096)))
+        self.assertFalse(locks.matches("report.docx", 162,
+                                       self.head("x" * 162)))
+        thumbs = rules["thumbs"]
+        self.assertTrue(thumbs.matches("Thumbs.db", 100,
+                                       self.head(self.OLE + "x" * 92)))
+        self.assertFalse(thumbs.matches("Thumbs.db", 100,
+                                        self.head("x" * 100)))
+
+    def test_renamed_document_does_not_pass(self):
+        rule = ClassifierRule("thumbs", glob="Thumbs.db",
+                              magic="d0cf11e0a1b11ae1", max_size=512)
+        document = self.OLE + "x" * 4096
+        self.assertFalse(rule.matches("Thumbs.db", len(document),
+                                      self.head(document)))
+        self.assertFalse(rule.matches("Thumbs.db", 100,
+                                      self.head("PK\3\4" + "x" * 96)))
+        self.assertFalse(rule.matches("report.doc", 100,
+                                      self.head(self.OLE + "x" * 92)))
+        self.assertTrue(rule.matches("d/Thumbs.db", 100,
+                                     self.head(self.OLE + "x" * 92)))
+
+    def test_path_globs_and_extensions(self):
+        rule = ClassifierRule("logs", action="inspect", glob="d/*.log",
+                              extension="LOG")
+        self.assertTrue(rule.matches("d/x.log", 1, self.head("x")))
+        self.assertFalse(rule.matches("x.log", 1, self.head("x")))
+        self.assertFalse(rule.matches("d/x.txt", 1, self.head("x")))
+
+    def test_head_is_read_only_when_needed(self):
+        def head():
+            raise AssertionError("head read for a size mismatch")
+        rule = ClassifierRule("thumbs", glob="Thumbs.db",
+                              magic="d0cf11e0a1b11ae1", max_size=512)
+        self.assertFalse(rule.matches("Thumbs.db", 4096, head))
+
+
+if __name__ == "__main__":
+    unittest.main()
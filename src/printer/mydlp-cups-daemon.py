@@ -10,25 +10,68 @@ import sys
 
 from threading import Thread
 
+SEAP_PIPELINE = True
+
 class SeapClient():
 	def __init__(self, server, port):
 		self.server = server
 		self.port = port
+		self.connect(145)
+
+	def connect(self, timeout):
 		self.sock = socket.socket()
-		self.sock.settimeout(145)
+		self.sock.settimeout(timeout)
 		self.sock.connect((self.server, self.port))
+		self.buffer = ""
+		self.pending = 0
+
+	def readline(self):
+		pos = self.buffer.find("\n")
+		while pos < 0:
+			data = self.sock.recv(4096)
+			if data == "":
+				raise IOError("Seap connection closed")
+			self.buffer += data
+			pos = self.buffer.find("\n")
+		line = self.buffer[:pos].strip()
+		self.buffer = self.buffer[pos + 1:]
+		return line
+
+	def drain(self):
+		while self.pending > 0:
+			self.readline()
+			self.pending -= 1
 
 	def send(self, message):
 		for try_count in range(3):
 			try:
+				self.drain()
 				self.sock.sendall(message+"\r\n")
-				response = self.sock.recv(1024).strip()
+				response = self.readline()
 				return response
 			except IOError as why:
-				self.sock = socket()
-				self.sock.settimeout(10)
-				self.sock.connect((self.server, self.port))
+				self.connect(10)
 		return ""
+
+	def pipeline(self, messages):
+		self.drain()
+		self.sock.sendall("".join([message + "\r\n" for message in messages]))
+		return [self.readline() for message in messages]
+
+	def post(self, message):
+		self.sock.sendall(message + "\r\n")
+		self.pending += 1
+
+	def query(self, commands):
+		if SEAP_PIPELINE:
+			return self.pipeline(commands)
+		responses = []
+		for command in commands:
+			response = self.send(command)
+			responses.append(response)
+			if not response.startswith("OK"):
+				break
+		return responses
 		
 	def acl_query(self, file_path, user_name, file_name, printer_info):
 		try:
@@ -38,32 +81,20 @@ class SeapClient():
 			if not response.startswith("OK"):
 				return True
 			opid = response.split()[1]
-			response = self.send("SETPROP " + opid + " filename=" + file_name)
-			if not response.startswith("OK"):
-				return True
-
-			response = self.send("SETPROP " + opid + " printerName=" + printer_info) #TODO: should be used printer name
-			if not response.startswith("OK"):
-				return True
-
-			response = self.send("SETPROP " + opid + " burn_after_reading=true")
-			if not response.startswith("OK"):
-				return True
-
-			response = self.send("SETPROP " + opid + " user=" + user_name)
-			if not response.startswith("OK"):
-				return True
-
-			response = self.send("PUSHFILE " + opid + " " + file_path)
-			if not response.startswith("OK"):
-				return True
-
-			response = self.send("END " + opid)
-			if not response.startswith("OK"):
-				return True
-
-			response = self.send("ACLQ " + opid)
-			self.send("DESTROY " + opid)
+			responses = self.query([
+				"SETPROP " + opid + " filename=" + file_name,
+				"SETPROP " + opid + " printerName=" + printer_info, #TODO: should be used printer name
+				"SETPROP " + opid + " burn_after_reading=true",
+				"SETPROP " + opid + " user=" + user_name,
+				"PUSHFILE " + opid + " " + file_path,
+				"END " + opid,
+				"ACLQ " + opid])
+			self.post("DESTROY " + opid)
+			for response in responses:
+				if not response.startswith("OK"):
+					return True
+
+			response = responses[-1]
 			print response.split()[1]
 			if response.split()[1] == "block":
 				return False